@@ -16,6 +16,7 @@ import os
 from rpy import *
 import math
 import csv
+from timeseries import isnull, nullable
 
 import PySide.QtCore as QtCore
 import PySide.QtGui as QtGui
@@ -77,12 +78,7 @@ class AnalysisTimeseriesSelectorComboBox (QtGui.QComboBox):
                 self.setCurrentIndex (int (event.mimeData ().text ()))
                 self.setToolTip (self.labels [self.currentIndex ()])
     def makeIntoList (self, thing, length):
-        _list = []
-
-        for i in range (length):
-            _list.append (thing [i])
-
-        return _list
+        return nullable (thing, length)
     def getMostRecentTime (self, timeseriesId):
         _series = self.root.tss.series () [timeseriesId].getAllNormValues ()
         _seriesData = self.makeIntoList (_series, len (self.root.tss.series () [timeseriesId].getAllTimes ()))
@@ -653,7 +649,7 @@ class AnalysisPlotListItem (QtGui.QWidget):
 
                     values_list = []
                     for i in range(len(times)):
-                        if values[i] <> None:
+                        if not isnull(values[i]):
                             values_list.append(values[i])
                             
 
@@ -1420,12 +1416,7 @@ class AnalysisPlot (QtGui.QScrollArea):
         #print  _targetTimeseriesLatest
         
     def makeIntoList (self, thing, length):
-        _list = []
-
-        for i in range (length):
-            _list.append (thing [i])
-           
-        return _list
+        return nullable (thing, length)
     def exportCSV (self):
         _futurePeriods = self.root.futureSpinBox.value ()
         _outputFilename = os.path.expanduser ('~/.bcOutput.txt')
@@ -34,6 +34,7 @@ import graph
 import random
 import clusterlayout
 import analysis
+import registry
 import lag
 
 class KeyFilter (QtCore.QObject):
@@ -265,10 +266,11 @@ class MenuBar (QMenuBar):
             # Determine the frequency choices and setup the frequency choice comboBox
             self.root.timeslice = 0
             _frequencyChoices = set ()
-            _mainChoice = 'ALL (' + self.root.tss.slice_index (self.root.db) [1] ['interval'] + ')'
+            _sliceIndex = self.root.tss.slice_index (self.root.db)
+            _mainChoice = 'ALL (' + _sliceIndex [1] ['interval'] + ')'
 
             for _slice in self.root.tssids [1:]:
-                _frequencyChoices.add (self.root.tss.slice_index (self.root.db) [_slice] ['interval'])
+                _frequencyChoices.add (_sliceIndex [_slice] ['interval'])
 
             _allChoices = list ()
             _allChoices.append (_mainChoice)
@@ -1121,6 +1123,9 @@ class BrandCommunities (QMainWindow):
         self.CLUSTER = 1
         self.constants = constants.Constants ()
         self.constants._load_ ()
+        self.loadedCoefficients = None              # (db, seriessetid, coeffid) of tss and cm held in the registry
+        self.prefetcher = None
+        registry.the_registry.budget = getattr (self.constants, 'loadedDataMegabytes', 512) * 1024 * 1024
 
         # Docking windows
         try:
@@ -1561,11 +1566,35 @@ class BrandCommunities (QMainWindow):
             print ('ERROR: Attempt to pop beyond end of redo buffer')
             #anticipated
     def loadCoefficients (self):
-        self.tss = TimeSeriesSet (self.db, self.tssids [self.timeslice])
+        _tssid = self.tssids [self.timeslice]
+        _tss = registry.acquire_timeseriesset (self.db, _tssid)
         _scenario = self.scenarioSelectorCombo.currentIndex ()
-        self.cm = self.tss.loadcoefficients (self.db, self.tss.coeffids () [_scenario])
+        _coeffid = _tss.coeffids () [_scenario]
+        _cm = registry.acquire_coefficients (self.db, _tss, _coeffid)
+        self.releaseCoefficients ()
+        self.loadedCoefficients = (self.db, _tssid, _coeffid)
+        self.tss = _tss
+        self.cm = _cm
         self.xyTss = self.tss.clone ()
-        self.clusterCm = self.tss.loadcoefficients (self.db, self.tss.coeffids () [_scenario])
+        self.clusterCm = self.cm
+        self.prefetchNeighbours (_scenario)
+    def prefetchNeighbours (self, scenario):
+        # Load the adjacent timeslices and the other scenarios in the background so that switching to them is instant
+        self.cancelPrefetch ()
+        _plan = [(self.tssids [_slice], scenario) for _slice in (self.timeslice + 1, self.timeslice - 1) if 0 <= _slice < len (self.tssids)]
+        _plan += [(self.tssids [self.timeslice], _scenario) for _scenario in range (len (self.tss.coeffids ())) if _scenario != scenario]
+        self.prefetcher = registry.Prefetcher (self.db, _plan)
+        self.prefetcher.start ()
+    def cancelPrefetch (self, closing = False):
+        if self.prefetcher:
+            self.prefetcher.cancel (discard = closing)
+            self.prefetcher = None
+    def releaseCoefficients (self):
+        if self.loadedCoefficients:
+            _db, _tssid, _coeffid = self.loadedCoefficients
+            registry.release (_db, _tssid, _coeffid)
+            registry.release (_db, _tssid)
+            self.loadedCoefficients = None
     def loadTimeslice (self):
         if self.timeslice != self.loadedTimeslice:
             self.loadCoefficients ()
@@ -1937,10 +1966,11 @@ class BrandCommunities (QMainWindow):
             # Determine the frequency choices and setup the frequency choice comboBox
             self.timeslice = 0
             _frequencyChoices = set ()
-            _mainChoice = 'ALL (' + self.tss.slice_index (self.db) [1] ['interval'] + ')'
+            _sliceIndex = self.tss.slice_index (self.db)
+            _mainChoice = 'ALL (' + _sliceIndex [1] ['interval'] + ')'
 
             for _slice in self.tssids [1:]:
-                _frequencyChoices.add (self.tss.slice_index (self.db) [_slice] ['interval'])
+                _frequencyChoices.add (_sliceIndex [_slice] ['interval'])
 
             _allChoices = list ()
             _allChoices.append (_mainChoice)
@@ -3018,6 +3048,11 @@ The slider's range is between 0 and 100%, with 100% corresponding to the largest
         self.galaxy.view.cleanupOldData ()
         self.cluster.view.cleanupOldData ()
         self.social.view.cleanupOldData ()
+        self.cancelPrefetch (closing = True)
+        self.releaseCoefficients ()
+        if self.db:
+            registry.the_registry.discard (self.db.filepath ())
+            self.db.close_readers () # The prefetcher's read-only connections, closed once it gives them back
         self.db = None
         self.newSelector.loadTree ()
     def scrub (self, s):
@@ -3034,6 +3069,8 @@ The slider's range is between 0 and 100%, with 100% corresponding to the largest
         self.db = Database (filename)
         self.timeslice = 0
         self.tssids = TimeSeriesSet.seriessetids (self.db)
+        if getattr (self.constants, 'parallelLoad', False):
+            registry.preload (self.db, self.tssids)
         self.loadedTimeslice = -1
         self.loadTimeslice ()
         self.loadedTimeslice = 0
@@ -3210,11 +3247,17 @@ The slider's range is between 0 and 100%, with 100% corresponding to the largest
         event.accept()
     def leave (self):
         try:
+            self.cancelPrefetch ()
             self.interruptLayoutsAndWaitForCompletion ()
 
             if self.db and self.bcFiles:
                 self.bcFiles.saveConfiguration ()
 
+            self.app.log (Coefficients.touched_report ())
+            self.app.log (registry.the_registry.report ())
+            if Database.profile:
+                self.app.log ('Database profile:\n%s' % Database.profile_report ())
+
             self.socialLayoutThread.exit ()
             self.galaxyLayoutThread.exit ()
             self.clusterLayoutThread.exit ()
@@ -3238,6 +3281,13 @@ class BCTimeseriesTransformComboBox (QtGui.QComboBox):
 
         QtCore.QObject.connect (self, QtCore.SIGNAL ('currentIndexChanged (int)'), self.selectionChanged)
 if __name__ == '__main__':
+    # The processes that load the timeslices in parallel must be started before Qt is, see registry.start_preload_pool ()
+    _constants = constants.Constants ()
+    _constants._load_ ()
+
+    if getattr (_constants, 'parallelLoad', False):
+        registry.start_preload_pool ()
+
     app = QApplication (sys.argv)
 
     # Set the aplication-wide stylesheet
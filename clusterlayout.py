@@ -5,6 +5,7 @@ import time
 import PySide
 import math
 import graph
+import numpy
 import tools
 
 from PySide.QtCore import *
@@ -50,6 +51,7 @@ class ClusterLayoutThread (QThread):
         self.suspend = False
         QtCore.QObject.connect (self, QtCore.SIGNAL ('done ()'), self.root.cluster.view.mainThread.display) # Starts from here
         self.secondaryScaling = CLUSTER_MARKER_DIAMETER
+        self.layoutCache = graph.LayoutCache ()
     def setup (self, nodes, cm): ###  Imp function
         
         self.nodes = nodes
@@ -213,6 +215,57 @@ clusterlayout.Cluster instance at 0x01BD8F80>}"""
                     self.root.cluster.view.visibleNodeDetails.setPosition (_node, QPointF (_x, _y))
                     self.root.cluster.view.visibleNodeDetails.addIndex (_node)
         #print self.root.cluster.view.circles           
+    @staticmethod
+    def linkStrengths (norm, visible, minimum):
+        # The (coefficients, sources, targets) arrays of the links between visible nodes stronger than minimum, strongest first.
+        # Each pair of nodes is taken once, from the lower triangle of the norm CsrMatrix; equal coefficients come last row last
+        _rows = numpy.repeat (numpy.arange (norm.N), numpy.diff (norm.indptr))
+        _columns = norm.indices.astype (numpy.int64)
+        _keep = numpy.flatnonzero ((_columns < _rows) & (norm.data > minimum) & visible [_rows] & visible [_columns])
+        _order = _keep [numpy.argsort (norm.data [_keep], kind = 'mergesort') [::-1]]
+        return norm.data [_order], _rows [_order], _columns [_order]
+    @staticmethod
+    def clusterLabelling (sources, targets, nodeCount):
+        # Clusters the nodes by taking the links in turn: a link between two unallocated nodes starts a new cluster, a link from an
+        # allocated node brings an unallocated one into its cluster and a link between two allocated nodes is ignored. So each node
+        # is decided by its first link; it joins the cluster of the node at the other end if that node was decided earlier.
+        # These parent pointers form a disjoint-set forest whose roots are the nodes that started a cluster, and jumping every pointer
+        # to its grandparent until they all point at their roots labels all the nodes at once.
+        # Returns an array of cluster labels, numbered in the order the clusters were started, -1 for nodes without links, and the
+        # array of the allocated nodes by cluster, in the order they joined it
+        _linkCount = len (sources)
+        _first = numpy.empty (nodeCount, dtype = numpy.int64)
+        _first.fill (_linkCount)
+
+        for _ends in (targets, sources):
+            _nodes, _index = numpy.unique (_ends, return_index = True)
+            _first [_nodes] = numpy.minimum (_first [_nodes], _index)
+
+        _allocated = numpy.flatnonzero (_first < _linkCount)
+        _link = _first [_allocated]
+        _isSource = sources [_link] == _allocated
+        _other = numpy.where (_isSource, targets [_link], sources [_link])
+
+        # The source of the link that starts a cluster is its root, the target points at it
+        _parent = numpy.arange (nodeCount)
+        _joins = (_first [_other] < _link) | ~_isSource
+        _parent [_allocated [_joins]] = _other [_joins]
+
+        while True:
+            _grandparent = _parent [_parent]
+
+            if (_grandparent == _parent).all ():
+                break
+
+            _parent = _grandparent
+
+        _roots = _allocated [_parent [_allocated] == _allocated]
+        _labels = numpy.empty (nodeCount, dtype = numpy.int64)
+        _labels.fill (-1)
+        _labels [_roots [numpy.argsort (_first [_roots])]] = numpy.arange (len (_roots))
+        _labels [_allocated] = _labels [_parent [_allocated]]
+        _members = _allocated [numpy.lexsort ((~_isSource, _link, _labels [_allocated]))]
+        return _labels, _members
     def doClustering (self):
         resource_usage = ConciseMonitor ()
         self.root.cluster.view.links = []
@@ -222,78 +275,45 @@ clusterlayout.Cluster instance at 0x01BD8F80>}"""
         self.clusterCount = 0
 
         # Make a list of visible nodes
-        #print enumerate(self.nodes)
-        for _index, _node in enumerate (self.nodes):
-            if not self.nodes [_index].hiding:
-                self.nodeList.append (_index)
-                _node.cluster.linksIn = []
-                _node.cluster.linksOut = []
-
-        self.unallocatedNodes = self.nodeList [:]
-        resource_usage.report ('Cluster: Visible nodes')
-
-        # Calculate link strengths
-        _sparse = self.cm.sparse
-        _strengths = []
+        _visible = numpy.array ([not _node.hiding for _node in self.nodes], dtype = bool)
+        self.nodeList = numpy.flatnonzero (_visible).tolist ()
 
-        for i, data in enumerate (self.cm.norm):
-            if i in self.nodeList:
-                for j in data:
-                    if j < i:
-                        if j in self.nodeList:
-                            _coeff = data [j]
+        for _index in self.nodeList:
+            self.nodes [_index].cluster.linksIn = []
+            self.nodes [_index].cluster.linksOut = []
 
-                            if _coeff > 0.005:
-                                _strengths.append ([_coeff, i, j])
+        resource_usage.report ('Cluster: Visible nodes')
 
-        self.strengths = sorted (_strengths, key = lambda _strength: _strength [0])
+        # Calculate link strengths, strongest first
+        _coefficients, _sources, _targets = self.linkStrengths (self.cm.norm, _visible, 0.005)
         resource_usage.report ('Cluster: Link strengths')
 
-        # Create the links
+        # Create the links, weakest first
         _maxCoefficient = 1.0 if self.root.cm.maxabscoeff () == 0.0 else self.root.cm.maxabscoeff ()
+        _strong = numpy.flatnonzero (_coefficients > _cutoff) [::-1]
 
-        for _link in self.strengths:
-            _coeff, i, j = _link
-
-            if _coeff > _cutoff:
-                _linkObject = self.root.cluster.view.addLink (i, j, _coeff, _maxCoefficient)
-                _linkObject.state = universeNamespace.LinkDrawState.RESET
-                _linkObject.zValue = 1
-                self.root.cluster.view.links.append (_linkObject)
+        for _coeff, i, j in zip (_coefficients [_strong].tolist (), _sources [_strong].tolist (), _targets [_strong].tolist ()):
+            _linkObject = self.root.cluster.view.addLink (i, j, _coeff, _maxCoefficient)
+            _linkObject.state = universeNamespace.LinkDrawState.RESET
+            _linkObject.zValue = 1
+            self.root.cluster.view.links.append (_linkObject)
 
         resource_usage.report ('Cluster: Create links')
 
         # Do the clustering
         self.clusterMembership = dict ()
-        _strengths = self.strengths [:]
-        _clusterCount = -1
-        print "cluster"
-        print self.unallocatedNodes
-        while len (_strengths):
-            if self.interruptRequested (): break
-            _coeff, _i, _j = _strengths.pop ()
+        self.clusterLabels, _members = self.clusterLabelling (_sources, _targets, len (self.nodes))
 
-            if _i in self.clusterMembership:
-                if _j not in self.clusterMembership:
-                    self.clusterMembership [_j] = self.clusterMembership [_i]
-                    self.clusters [self.clusterMembership [_i].index ()].addNode (_j)
-                    self.unallocatedNodes.remove (_j)
-            else:
-                if _j in self.clusterMembership:
-                    self.clusterMembership [_i] = self.clusterMembership [_j]
-                    self.clusters [self.clusterMembership [_j].index ()].addNode (_i)
-                    self.unallocatedNodes.remove (_i)
-                else:
-                    _clusterCount += 1
-                    _cluster = Cluster (_clusterCount)
-                    self.clusters.append (_cluster)
-                    self.clusterMembership [_i] = _cluster
-                    self.clusterMembership [_j] = _cluster
-                    _cluster.addNode (_i)
-                    _cluster.addNode (_j)
-                    
-                    self.unallocatedNodes.remove (_i)
-                    self.unallocatedNodes.remove (_j)
+        if not self.interruptRequested ():
+            for _nodeIndex, _label in zip (_members.tolist (), self.clusterLabels [_members].tolist ()):
+
+                if _label == len (self.clusters):
+                    self.clusters.append (Cluster (_label))
+
+                self.clusterMembership [_nodeIndex] = self.clusters [_label]
+                self.clusters [_label].addNode (_nodeIndex)
+
+        self.unallocatedNodes = [_nodeIndex for _nodeIndex in self.nodeList if _nodeIndex not in self.clusterMembership]
 
         resource_usage.report ('Cluster: Clustering')
 
@@ -310,25 +330,32 @@ clusterlayout.Cluster instance at 0x01BD8F80>}"""
         if len (self.clusters) > 0:
             _fruchtTime = ConciseMonitor ()
             self.root.message [self.root.CLUSTER].display ('Starting layout')
-            _initialPositions = []
+            _circlePositions = []
             
             for i in range (len (self.allCoefficients)):
                 _angle = 2.0 * math.pi * i / len (self.allCoefficients)
                 _position = QPointF (math.cos (_angle), math.sin (_angle))
-                _initialPositions.append (_position)
+                _circlePositions.append (_position)
 
+            # Start from where the last layout left the clusters and only relax those whose members or coefficients have changed
+            _groups = [_cluster.nodes () for _cluster in self.clusters]
+            _initialPositions, _moving = self.layoutCache.start (_groups, self.allCoefficients, _circlePositions, \
+                                                                 context = (self.root.db.filepath (), len (self.nodes)))
             _graph = graph.FruchtermanReingold (self.root.application, self.root.cluster.view, self.allCoefficients, _initialPositions, \
                                                 checkInterruptFunction = self.interruptRequested, \
-                                                messageItem = self.root.message [self.root.CLUSTER], minimumKineticEnergy = 0.001)
-            _fruchtTime.report ('    Cluster: RuchtermanFreingold')
+                                                messageItem = self.root.message [self.root.CLUSTER], minimumKineticEnergy = 0.001, \
+                                                moving = _moving)
+            _fruchtTime.report ('    Cluster: RuchtermanFreingold (%d of %d clusters moved, %s iterations)' % (len (_moving), len (_groups), _graph.iterations ()))
                     
             if _graph.wasInterrupted ():
                 self._coordinates = []
+            else:
+                self.layoutCache.store (_groups, self.allCoefficients, _graph.result ())
 
             self._coordinates = _graph.result ()
 
             for i, dummy in enumerate (self._coordinates):
-                self._coordinates [i] *= self.root.TOTAL_SCALING
+                self._coordinates [i] = self._coordinates [i] * self.root.TOTAL_SCALING
 
             # Draw the graph
             #_graphTime = ConciseMonitor ()
@@ -647,12 +674,7 @@ clusterlayout.Cluster instance at 0x01BD8F80>}"""
         self.root.message [self.root.CLUSTER].hide ()
         
     def makeIntoList (self, thing, length):
-        _list = []
-
-        for i in range (length):
-            _list.append (thing [i])
-           
-        return _list
+        return nullable (thing, length)
 class ClusterCircle (QGraphicsEllipseItem):
     def __init__ (self, root, x, y, width, height, nodeList):
         QGraphicsEllipseItem.__init__ (self)
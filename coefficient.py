@@ -7,13 +7,20 @@
 #       Coefficients handles all the coefficient matrices for a given TimeSeriesSet.
 #
 #       The matrix are named { value best secondary direction norm }.
-#       See matrix_names in this module.
+#       See matrix_names in this module. Each matrix is loaded on first use
+#       of its attribute, e.g. cm.norm, or up front with cm.prefetch(names).
+#       Coefficients.touched counts the matrices loaded during the session.
 #
 #       value   is the matrix of coefficients produced by the Jaba Importer
 #               and as such is always present in any V4.000 BC database.
 #
 #       { best secondary direction norm } are matrices derived from value, and
-#               as such are automatically created in the Database ONCE only
+#               as such are automatically created in the Database ONCE only,
+#               or derived in memory when Coefficients.derive_in_memory is set
+#               or when the Database has no derived tables and is read-only.
+#               Matrices derived in memory are cached as .npz files in
+#               Coefficients.derived_cachedir, keyed by database, coeffid and
+#               the database file's mtime and size.
 #
 ###################################################################################
 #
@@ -24,9 +31,10 @@
 #       There are multiple CoefficientMatrix in the database for each matrix name
 #       for a given coeffid. 
 #
-#       CoefficientMatrix is currently a subclass of Sparse, i.e. the storage for
-#       coefficients in the matrix is always handled in a sparse manner, which saves
-#       much in memory storage and greatly improves access time.
+#       CoefficientMatrix is a subclass of CsrMatrix, i.e. the coefficients are held
+#       in compressed sparse row arrays. cm[i] is a read-only dict-like view of row i,
+#       so clients keep using  j in cm[i]  and  cm[i][j]  as they did when each row
+#       was a dict, at a fraction of the memory.
 #
 #       CoefficientMatrix mimics the interface and behaviour of its Java analogue
 #       CREATE TABLE coeffvalue(coeffid INTEGER, seriesid1 INTEGER, seriesid2 INTEGER, coeff REAL);
@@ -39,7 +47,8 @@
 ####################################################################################
 
 
-import sys
+import glob, hashlib, itertools, os, sys
+import numpy
 from database import *
 from dict import *
 from sparse import *
@@ -64,7 +73,10 @@ derived_matrix_indexnames       = dict( (matname, '%s_coeffid_seriesid1_seriesid
 
 class Coefficients(object):
 
-    def __init__(self, db, tss, coeffid, sparse=False):
+    derive_in_memory = False                                        # True: never write the derived tables, derive the matrices from value at load time
+    derived_cachedir = os.path.expanduser('~/.bc_cache')            # where matrices derived in memory are cached; None disables the cache
+
+    def __init__(self, db, tss, coeffid, sparse=False, value=None):     # value: the CSR arrays of the value matrix when already loaded, see value_arrays()
         resource_usage = ConciseMonitor()
 
         self.sparse = sparse
@@ -74,16 +86,37 @@ class Coefficients(object):
         self._coeffid = coeffid
         self._dict = Dict(db,"CoefficientMatrix",coeffid)          # legacy: CoefficientMatrix now refers to Coefficients in the dict for this class
         self._matrices = dict()                                    # all matrices: key is coefficient matrix name
+        self._derivedstored = self.derived_tables_stored(db)      # the derived tables are in the file, whichever connection looks
+        self._inmemory = self._derivesinmemory(db)
+        self._derived = None                                       # { matrixname => (indptr, indices, data) } when derived in memory
+        self._value = value                                        # (indptr, indices, data) of the value matrix until it is loaded
+
+        resource_usage.report('%s #%s init, %s matrices loaded on demand' % ('Coefficients', coeffid, len(matrix_names)))
+
+    # public attributes: each of the named CoefficientMatrixs contained in this Coefficients object, loaded on first use
+    value           = property(lambda self: self.getmatrix('value'))        # original imported coefficients
+    coeffs          = value                                                 # legacy
+    best            = property(lambda self: self.getmatrix('best'))         # best coefficients
+    secondary       = property(lambda self: self.getmatrix('secondary'))    # secondary coefficients
+    direction       = property(lambda self: self.getmatrix('direction'))    # direction coefficients
+    norm            = property(lambda self: self.getmatrix('norm'))         # normalised coefficients
+
+    touched = dict()                                                        # { matrixname => number of Coefficients that loaded it } for this session
+
+    def prefetch(self, matrixnames=matrix_names):                           # load the named matrices now rather than on first use
+        for matrixname in matrixnames:
+            self.getmatrix(matrixname)
+
+    def nbytes(self):                                                       # memory held by the loaded matrices' arrays, counting shared arrays once
+        arrays = dict( (id(a), a) for m in self._matrices.values() for a in (m.indptr, m.indices, m.data) )
+        return sum(a.nbytes for a in arrays.values())
 
-        # public attributes: each of the named CoefficientMatrixs contained in this Coefficients object
-        self.value          = self._load('value')                  # original imported coefficients
-        self.coeffs         = self.value                           # legacy
-        self.best           = self._load('best')                   # best coefficients
-        self.secondary      = self._load('secondary')              # secondary coefficients
-        self.direction      = self._load('direction')              # direction coefficients
-        self.norm           = self._load('norm')                   # normalised coefficients
+    def loaded(self):                                                       # names of the matrices loaded so far
+        return [ matrixname for matrixname in matrix_names if matrixname in self._matrices ]
 
-        resource_usage.report('%s #%s init %s matrices, values.cardinality=%s .fill=%.2f%% .mac=%s' % ('Coefficients', coeffid, len(matrix_names), self.cardinality(), 100*self.fill(), self.maxabscoeff()))
+    @classmethod
+    def touched_report(cls):
+        return 'Coefficients matrices loaded this session: %s' % ' '.join('%s=%s' % (matrixname, cls.touched.get(matrixname, 0)) for matrixname in matrix_names)
 
     def N(self):                return self._N
     def isarima(self):          return self._dict.getbool("isarima")
@@ -95,7 +128,14 @@ class Coefficients(object):
     def topn(self):             return self._dict.getint("topn")
 
     def values_issymmetrical(self):
-        return self._dict.getbool("issymm")
+        return self.dict_issymm(self._dict)
+
+    @staticmethod
+    def dict_issymm(coeffdict):                                             # the Coefficients's dict 'issymm' tells us if the original imported coeffvalues matrix is symmetrical
+        try:
+            return coeffdict.getbool("issymm")
+        except KeyError:
+            return False                                                    # there are a few V4.000 databases that do not a 'issymm' entry in the dict :(
 
     def coeffid(self):
         return self._coeffid
@@ -103,31 +143,134 @@ class Coefficients(object):
     def db(self):
         return self._db
 
+    def setdb(self, db):                    # hand Coefficients loaded on another connection, e.g. in another thread, over to db
+        self._db = db
+        if self._derived is None and not any(matrixname in self._matrices for matrixname in derived_matrix_names):
+            self._inmemory = self._derivesinmemory(db)      # db decides, e.g. it stores the derived tables where a read-only db.reader() cannot
+
+    def _derivesinmemory(self, db):
+        return Coefficients.derive_in_memory or not self._derivedstored and db.readonly()
+
     def tss(self):
         return self._tss
 
     def cardinality(self, matrixname='value'):
-        return self._matrices[matrixname].cardinality()
+        return self.getmatrix(matrixname).cardinality()
 
     def fill(self, matrixname='value'):
-        return self._matrices[matrixname].fill()
+        return self.getmatrix(matrixname).fill()
 
     def getmatrix(self, matrixname='value'):
+        if matrixname not in self._matrices:
+            if matrixname not in matrix_names: raise Exception, "Coefficients: no matrix named %s, expected one of %s" % (matrixname, ' '.join(matrix_names))
+            self._load(matrixname)
+            Coefficients.touched[matrixname] = Coefficients.touched.get(matrixname, 0) + 1
         return self._matrices[matrixname]
 
     def issymmetrical(self, matrixname='value'):
-        return self._matrices[matrixname].issymmetrical()
+        return self.getmatrix(matrixname).issymmetrical()
 
     def maxabscoeff(self, matrixname='value'):
-        return self._matrices[matrixname].maxabscoeff()
+        return self.getmatrix(matrixname).maxabscoeff()
 
     def readyloop(self, matrixname='value'):
-        return (self._matrices[matrixname], self._N)
+        return (self.getmatrix(matrixname), self._N)
+
+    def isderivedinmemory(self):
+        return self._inmemory
 
     def _load(self, matrixname='value'):
-        self._matrices[matrixname] = CoefficientMatrix(matrixname, self)
+        if self._inmemory and matrixname != imported_matrix_name:
+            if self._derived is None:
+                self._derived = self._derive()
+            self._matrices[matrixname] = CoefficientMatrix(matrixname, self, self._derived[matrixname])
+        elif matrixname == imported_matrix_name and self._value is not None:
+            self._matrices[matrixname] = CoefficientMatrix(matrixname, self, self._value)
+            self._value = None
+        else:
+            self._matrices[matrixname] = CoefficientMatrix(matrixname, self)
         return self._matrices[matrixname]
 
+    def _derive(self):                                      # the derived matrices' CSR arrays, from the cache or computed from value
+        derive_usage = ConciseMonitor()
+        value = self.getmatrix(imported_matrix_name)
+        cachefile = self._derived_cachefile()
+        arrays = None
+        if cachefile and os.path.exists(cachefile):
+            try:
+                cached = numpy.load(cachefile)
+                arrays = dict( (name, cached[name]) for name in [ 'indptr', 'indices' ] + derived_matrix_names )
+                cached.close()
+            except:
+                arrays = None                                           # a damaged cache file is simply recomputed
+        if arrays is None:
+            rows = numpy.repeat(numpy.arange(value.N), numpy.diff(value.indptr))
+            derived = CoefficientMatrix.derived_cells(rows, value.indices, value.data, value.N, value.maxabscoeff())
+            i, j = derived['best'][0], derived['best'][1]                # all derived matrices share the same cells
+            rows, cols = numpy.concatenate((i, j)), numpy.concatenate((j, i))
+            order = numpy.lexsort((cols, rows))
+            arrays = dict(indptr=numpy.zeros(value.N+1, dtype=numpy.int64), indices=cols[order].astype(numpy.int32))
+            numpy.cumsum(numpy.bincount(rows, minlength=value.N), out=arrays['indptr'][1:])
+            for matrixname in derived_matrix_names:
+                coeffs = derived[matrixname][2].astype(numpy.float64)
+                arrays[matrixname] = numpy.concatenate((coeffs, coeffs))[order]
+            if cachefile:
+                self._save_derived(cachefile, arrays)
+        indptr, indices = arrays['indptr'], arrays['indices']
+        if numpy.array_equal(indptr, value.indptr) and numpy.array_equal(indices, value.indices):
+            indptr, indices = value.indptr, value.indices                # a symmetrical value matrix has the same cells as the derived ones
+        res = dict()
+        for matrixname in derived_matrix_names:
+            data = arrays[matrixname]
+            keep = data != 0
+            if keep.all():                                              # best, direction and norm share the index arrays
+                res[matrixname] = (indptr, indices, data)
+            else:                                                       # secondary drops its zeros, as it does when loaded from the database
+                kept = numpy.concatenate(([0], numpy.cumsum(keep)))
+                res[matrixname] = (kept[indptr], indices[keep], data[keep])
+        derive_usage.report('%s #%s derived %s in memory%s' % ('Coefficients', self._coeffid, ' '.join(derived_matrix_names), ' from %s' % cachefile if cachefile else ''))
+        return res
+
+    def _derived_cachefile(self):                           # cache file path for this coeffid at the database file's current mtime and size, or None
+        if not Coefficients.derived_cachedir:
+            return None
+        try:
+            stat = os.stat(self._db.filepath())
+        except OSError:
+            return None
+        return os.path.join(Coefficients.derived_cachedir, '%s-%s-%d-%d.npz' % (self._derived_cacheprefix(), self._coeffid, int(stat.st_mtime*1000), stat.st_size))
+
+    def _derived_cacheprefix(self):
+        return hashlib.md5(os.path.realpath(self._db.filepath())).hexdigest()[:16]
+
+    def _save_derived(self, cachefile, arrays):
+        try:
+            if not os.path.isdir(Coefficients.derived_cachedir):
+                os.makedirs(Coefficients.derived_cachedir)
+            for stale in glob.glob(os.path.join(Coefficients.derived_cachedir, '%s-%s-*.npz' % (self._derived_cacheprefix(), self._coeffid))):
+                os.remove(stale)                                        # cached for an earlier version of the database file
+            temporary = '%s.%s.tmp' % (cachefile, os.getpid())
+            out = open(temporary, 'wb')
+            numpy.savez(out, **arrays)
+            out.close()
+            os.rename(temporary, cachefile)
+        except (IOError, OSError):
+            pass                                                        # the cache is an optimisation only
+
+    @staticmethod
+    def value_arrays(db, coeffid, s2o):                     # the CSR arrays (indptr, indices, data) of coeffid's value matrix, its rows and columns being the ordinals of s2o
+        issymm = Coefficients.dict_issymm(Dict(db,"CoefficientMatrix",coeffid))
+        fetched = db.iterRows("SELECT seriesid1,seriesid2,coeff FROM %s WHERE coeffid=?" % matrix_tablenames[imported_matrix_name], coeffid)
+        where = 'coeffid=%s in database %s for matrix %s' % (coeffid, db.basename(), imported_matrix_name)
+        matrix = CsrMatrix(len(s2o))
+        matrix.load_triplets(*CoefficientMatrix.cells(fetched, s2o, issymm, where))
+        return matrix.indptr, matrix.indices, matrix.data
+
+    @classmethod
+    def derived_tables_stored(cls,db):                      # True if all the derived coeff tables are in db
+        schema = db.stored_schema()
+        return all(tablename in schema for tablename in derived_matrix_tablenames.values())
+
     @classmethod
     def timeseriesset_matrix_index(cls,db,seriessetid):     # dict of { coeffid => coeffdict } for each CoefficientMatrix owned by seriessetid
         return dict( (coid,Dict(db,"CoefficientMatrix",coid)) for coid in db.selectColumn("SELECT coeffid FROM coeff WHERE seriessetid=?",seriessetid) )
@@ -199,10 +342,10 @@ class Coefficients(object):
 #
 ###################################################################################
 
-class CoefficientMatrix(SparseMatrix):    # a read-only SparseMatrix of coefficients
-    """ CoefficientMatrix is a SparseMatrix that stores coefficients for a Coefficients instance """
+class CoefficientMatrix(CsrMatrix):      # a read-only CsrMatrix of coefficients
+    """ CoefficientMatrix is a CsrMatrix that stores coefficients for a Coefficients instance """
 
-    def __init__(self, matrixname, coefficients):
+    def __init__(self, matrixname, coefficients, arrays=None):
 
         init__usage = ConciseMonitor()
 
@@ -216,33 +359,26 @@ class CoefficientMatrix(SparseMatrix):    # a read-only SparseMatrix of coeffici
                                         # and as such will be created on demand by this constructor if it is not
                                         # found in the database
 
-        try:
-            db.cursor().execute("SELECT seriesid1,seriesid2,coeff FROM %s WHERE coeffid=?" % matrix_tablenames[matrixname],[coefficients.coeffid()])
-        except:
-            assert matrixname != imported_matrix_name
-            self._create_all_derived_tables(db)
-            db.cursor().execute("SELECT seriesid1,seriesid2,coeff FROM %s WHERE coeffid=?" % derived_matrix_tablenames[matrixname], [coefficients.coeffid()])
-
-        cardinality = 0
-        maxabscoeff = 0
-        s2o = tss.seriesid2ordinal()
-        if matrixname == 'value':
-            issymm = coefficients.values_issymmetrical()    # the original imported value matrix may or may not be symmetrical
+        if arrays is not None:                              # a derived matrix computed in memory by Coefficients, or the value matrix loaded elsewhere
+            self.indptr, self.indices, self.data = arrays
+            issymm = coefficients.values_issymmetrical() if matrixname == imported_matrix_name else True
         else:
-            issymm = True                                   # all derived matrices are symmetrical
-        for (id1, id2, coeff) in db.cursor().fetchall():
-            if id1 not in s2o: raise Exception, "seriesid1=%s not found for coeffid=%s in database %s for matrix %s" % (id1, coefficients.coeffid(), db.basename(), self._matrixname)
-            if id2 not in s2o: raise Exception, "seriesid2=%s not found for coeffid=%s in database %s for matrix %s" % (id2, coefficients.coeffid(), db.basename(), self._matrixname)
-            if coeff:
-                cardinality += 1
-                self [s2o[id1]] [s2o[id2]] = coeff
-                if issymm:
-                    assert s2o[id1] > s2o[id2]
-                    cardinality += 1
-                    self [s2o[id2]] [s2o[id1]] = coeff
-                if abs(coeff) > maxabscoeff:
-                    maxabscoeff = abs(coeff)
+            try:
+                fetched = db.iterRows("SELECT seriesid1,seriesid2,coeff FROM %s WHERE coeffid=?" % matrix_tablenames[matrixname], coefficients.coeffid())
+            except:
+                assert matrixname != imported_matrix_name
+                self._create_all_derived_tables(db)
+                fetched = db.iterRows("SELECT seriesid1,seriesid2,coeff FROM %s WHERE coeffid=?" % derived_matrix_tablenames[matrixname], coefficients.coeffid())
 
+            if matrixname == 'value':
+                issymm = coefficients.values_issymmetrical()    # the original imported value matrix may or may not be symmetrical
+            else:
+                issymm = True                                   # all derived matrices are symmetrical
+            where = 'coeffid=%s in database %s for matrix %s' % (coefficients.coeffid(), db.basename(), self._matrixname)
+            rows, cols, values = self.cells(fetched, tss.seriesid2ordinal(), issymm, where)
+            self.load_triplets(rows, cols, values)
+        cardinality = len(self.data)
+        maxabscoeff = float(numpy.abs(self.data).max()) if cardinality else 0
         self._cardinality = cardinality
         self._fill = cardinality / float(self.N*self.N)
         self._issymmetrical = issymm
@@ -269,83 +405,114 @@ class CoefficientMatrix(SparseMatrix):    # a read-only SparseMatrix of coeffici
         return self._matrixname
 
 
+    @staticmethod
+    def cells(fetched, s2o, issymm, where):
+        """ map the (seriesid1, seriesid2, coeff) rows fetched from a coeff table to the non-zero cells (rows, cols, values) of a matrix, mirrored if issymm;
+            fetched may be any iterable, e.g. Database.iterRows(), and is consumed Database.fetch_rows at a time """
+        seriesids = numpy.array(sorted(s2o), dtype=numpy.int64)
+        ordinals = numpy.array([ s2o[seriesid] for seriesid in seriesids.tolist() ], dtype=numpy.int64)
+        fetched = iter(fetched)
+        parts = [ ]
+        while True:
+            batch = list(itertools.islice(fetched, Database.fetch_rows))
+            if not batch:
+                break
+            cells = numpy.array(batch, dtype=numpy.float64).reshape(-1, 3)     # a NULL coeff becomes NaN and is dropped with the zeros
+            ids = cells[:,:2].astype(numpy.int64)
+            pos = numpy.searchsorted(seriesids, ids).clip(0, max(len(seriesids) - 1, 0))
+            found = seriesids[pos] == ids if len(seriesids) else numpy.zeros(ids.shape, dtype=bool)
+            if not found.all():
+                k = numpy.flatnonzero(~found.all(axis=1))[0]                # report the first bad row, seriesid1 before seriesid2
+                col = 0 if not found[k,0] else 1
+                raise Exception, "seriesid%s=%s not found for %s" % (col+1, batch[k][col], where)
+            coeffs = cells[:,2]
+            nonzero = (coeffs != 0) & ~numpy.isnan(coeffs)
+            parts.append((ordinals[pos[nonzero,0]], ordinals[pos[nonzero,1]], coeffs[nonzero]))
+        if parts:
+            rows, cols, values = [ numpy.concatenate(part) for part in zip(*parts) ]
+        else:
+            rows, cols, values = numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0)
+        if issymm:
+            assert (rows > cols).all()                                      # only the lower triangle is stored
+            rows, cols = numpy.concatenate((rows, cols)), numpy.concatenate((cols, rows))
+            values = numpy.concatenate((values, values))
+        return rows, cols, values
+
+    @staticmethod
+    def derived_cells(rows, cols, values, n, maxabscoeff):
+        """ derive the lower triangle cells (i, j, coeffs) of each derived matrix from the non-zero cells of an n x n value matrix; returns { matrixname => (i, j, coeffs) } """
+        lower = rows > cols                                 # cell (i,j) below the diagonal gives coeff1 of pair i>j
+        upper = rows < cols                                 # cell (j,i) above the diagonal gives coeff2 of pair i>j
+        key1 = rows[lower] * n + cols[lower]
+        key2 = cols[upper] * n + rows[upper]
+        keys = numpy.union1d(key1, key2)                    # every pair i>j with a non-zero coeff either way, in row major order
+        coeff1 = numpy.zeros(len(keys))
+        coeff2 = numpy.zeros(len(keys))
+        coeff1[numpy.searchsorted(keys, key1)] = values[lower]
+        coeff2[numpy.searchsorted(keys, key2)] = values[upper]
+        first = numpy.abs(coeff1) >= numpy.abs(coeff2)
+        best = numpy.where(first, coeff1, coeff2)
+        nonzero = best != 0
+        keys, first, best = keys[nonzero], first[nonzero], best[nonzero]
+        secondary = numpy.where(first, coeff2[nonzero], coeff1[nonzero])
+        direction = numpy.where(first, 1, 2)
+        norm = numpy.abs(best) / maxabscoeff if len(keys) else best
+        i, j = keys // n, keys % n
+        return dict(best=(i, j, best), secondary=(i, j, secondary), direction=(i, j, direction), norm=(i, j, norm))
+
     @classmethod
     def _create_all_derived_tables(cls, db):
         """ create and populate fresh derived tables in the database for all the derived coefficient matrices -- for all timeseries and all coeffids """
 
+        rebuild_usage = ConciseMonitor()
+        db_drop_create_usage = ConciseMonitor()
         for matrixname in derived_matrix_names:
             tablename = derived_matrix_tablenames[matrixname]
             indexname = derived_matrix_indexnames[matrixname]
-            db_drop_create_usage = ConciseMonitor()
-            db.execute("DROP TABLE IF EXISTS %s" % tablename)
             db.execute("DROP INDEX IF EXISTS %s" % indexname)
+            db.execute("DROP TABLE IF EXISTS %s" % tablename)
             db.execute("CREATE TABLE %s(coeffid INTEGER, seriesid1 INTEGER, seriesid2 INTEGER, coeff REAL)" % tablename)
-            db.execute("CREATE UNIQUE INDEX %s ON %s(coeffid,seriesid1,seriesid2)" % (indexname, tablename))
-            db_drop_create_usage.report('DROP AND CREATE TABLE %s and its INDEX' % tablename)
+        db_drop_create_usage.report('DROP AND CREATE TABLEs %s' % ' '.join(derived_matrix_tablenames.values()))
 
         ninsert = 0
-        for seriessetid in db.selectColumn("SELECT seriessetid FROM seriesset"):
-            create_usage = ConciseMonitor()
-            create_usage.report('CREATING post-import tables ONCE for database %s tssid %s' % (db.basename(), seriessetid))
-            o2s = { }                                               # map timeseries' ordinal to seriesid for a given seriessetid
-            s2o = { }                                               # and map seriesid to ordinal
-            ordinal = 0
-            for seriesid in db.selectColumn("SELECT seriesid FROM series WHERE seriessetid=? ORDER BY seriesid", seriessetid):
-                o2s[ordinal] = seriesid
-                s2o[seriesid] = ordinal
-                ordinal += 1
-            n = len(o2s)
-            for coeffid in db.selectColumn("SELECT coeffid FROM coeff WHERE seriessetid=?", seriessetid):
-                coeffdict = Dict(db,"CoefficientMatrix",coeffid)
-                try:
-                    issymm = coeffdict.getbool('issymm')    # the Coefficients's dict 'issymm' tells us if the original imported coeffvalues matrix is symmetrical
-                except:
-                    issymm = False                          # there are a few V4.000 databases that do not a 'issymm' entry in the dict :(
-                maxabscoeff = 0
-                originals = SparseMatrix(n)
-                db.cursor().execute("SELECT seriesid1,seriesid2,coeff FROM coeffvalue WHERE coeffid=?",[coeffid])
-                for (id1, id2, coeff) in db.cursor().fetchall():
-                    if id1 not in s2o:
-                        raise Exception("seriesid1=%s not found for coeffid=%s in database %s for coeffvalue" % (id1, coefficients.coeffid(), db.basename()))
-                    if id2 not in s2o:
-                        raise Exception("seriesid2=%s not found for coeffid=%s in database %s for coeffvalue" % (id2, coefficients.coeffid(), db.basename()))
-                    if coeff:
-                        originals [s2o[id1]] [s2o[id2]] = coeff
-                        if issymm:
-                            assert s2o[id1] > s2o[id2]
-                            originals [s2o[id2]] [s2o[id1]] = coeff
-                        if abs(coeff) > maxabscoeff:
-                            maxabscoeff = abs(coeff)
-                crumb = 0
-                for i in range(n):
-                    row = originals[i]
-                    for j in range(i):
-                        coeff1 = 0 if j not in row else row[j]
-                        coeff2 = 0 if i not in originals[j] else originals[j][i]
-                        if abs(coeff1) >= abs(coeff2):
-                            best, secondary, direction = coeff1, coeff2, 1
-                        else:
-                            best, secondary, direction = coeff2, coeff1, 2
-                        if best:
-                            norm = abs(best) / maxabscoeff
-                            id1 = o2s[i]
-                            id2 = o2s[j]
-                            db.execute_sans_commit("INSERT INTO %s(coeffid,seriesid1,seriesid2,coeff) VALUES(?,?,?,?)" % derived_matrix_tablenames['best'],
-                                coeffid, id1, id2, best)
-                            db.execute_sans_commit("INSERT INTO %s(coeffid,seriesid1,seriesid2,coeff) VALUES(?,?,?,?)" % derived_matrix_tablenames['secondary'],
-                                coeffid, id1, id2, secondary)
-                            db.execute_sans_commit("INSERT INTO %s(coeffid,seriesid1,seriesid2,coeff) VALUES(?,?,?,?)" % derived_matrix_tablenames['direction'],
-                                coeffid, id1, id2, direction)
-                            db.execute_sans_commit("INSERT INTO %s(coeffid,seriesid1,seriesid2,coeff) VALUES(?,?,?,?)" % derived_matrix_tablenames['norm'],
-                                coeffid, id1, id2, norm)
-                            ## create_usage.report('[%s] INSERT INTO {best,norm,direction...} WHERE coeffid=%s i=%s, j=%s' % (crumb, coeffid, i,j ))
-                            crumb += 4
-                db.commit()
-                create_usage = create_usage.report('INSERT INTO {best,norm,direction...} WHERE coeffid=%s, %s INSERT operations tssid %s' % (coeffid,crumb,seriessetid))
-                ninsert += crumb
-
-        create_usage.report('CREATE port-import tables complete, %s INSERT operations across all tssids' % ninsert)
-        return crumb
+        try:                                                        # all the INSERTs are one transaction, the indexes are created after the bulk load
+            for seriessetid in db.selectColumn("SELECT seriessetid FROM seriesset"):
+                create_usage = ConciseMonitor()
+                create_usage.report('CREATING post-import tables ONCE for database %s tssid %s' % (db.basename(), seriessetid))
+                seriesids = db.selectColumn("SELECT seriesid FROM series WHERE seriessetid=? ORDER BY seriesid", seriessetid)
+                s2o = dict( (seriesid, ordinal) for ordinal, seriesid in enumerate(seriesids) )
+                o2s = numpy.array(seriesids, dtype=numpy.int64)     # map timeseries' ordinal to seriesid for a given seriessetid
+                n = len(seriesids)
+                for coeffid in db.selectColumn("SELECT coeffid FROM coeff WHERE seriessetid=?", seriessetid):
+                    coeffdict = Dict(db,"CoefficientMatrix",coeffid)
+                    issymm = Coefficients.dict_issymm(coeffdict)
+                    fetched = db.iterRows("SELECT seriesid1,seriesid2,coeff FROM coeffvalue WHERE coeffid=?", coeffid)
+                    where = 'coeffid=%s in database %s for coeffvalue' % (coeffid, db.basename())
+                    rows, cols, values = cls.cells(fetched, s2o, issymm, where)
+                    maxabscoeff = numpy.abs(values).max() if len(values) else 0
+                    derived = cls.derived_cells(rows, cols, values, n, maxabscoeff)
+                    crumb = 0
+                    for matrixname in derived_matrix_names:
+                        i, j, coeffs = derived[matrixname]
+                        cells = zip([coeffid] * len(i), o2s[i].tolist(), o2s[j].tolist(), coeffs.tolist())
+                        db.executemany_sans_commit("INSERT INTO %s(coeffid,seriesid1,seriesid2,coeff) VALUES(?,?,?,?)" % derived_matrix_tablenames[matrixname], cells)
+                        crumb += len(cells)
+                    create_usage = create_usage.report('INSERT INTO {best,norm,direction...} WHERE coeffid=%s, %s INSERT operations tssid %s' % (coeffid,crumb,seriessetid))
+                    ninsert += crumb
+            db.commit()
+        except:
+            db.rollback()                                           # leave no half-built derived table behind: its presence means it is complete
+            for matrixname in derived_matrix_names:
+                db.execute("DROP TABLE IF EXISTS %s" % derived_matrix_tablenames[matrixname])
+            raise
+
+        index_usage = ConciseMonitor()
+        for matrixname in derived_matrix_names:
+            db.execute("CREATE UNIQUE INDEX %s ON %s(coeffid,seriesid1,seriesid2)" % (derived_matrix_indexnames[matrixname], derived_matrix_tablenames[matrixname]))
+        index_usage.report('CREATE INDEXes on the derived tables')
+
+        rebuild_usage.report('CREATE port-import tables complete, %s INSERT operations across all tssids' % ninsert)
+        return ninsert
 
 
 ###################################################################################
@@ -403,10 +570,32 @@ def report_coefficients(db,brief,update):
                 print ' - *** only found %d of %d coeff matrices' % (foundmat, totalmat)
 
 
+def report_full_scans(dbfile):       # load everything in dbfile, read-only so that it is not migrated, and report the queries that scanned whole tables
+    constants = Application.the_app.root.constants
+    profiling = getattr(constants,'profileDb',False)
+    constants.profileDb = True                          # the statements run are collected in Database.profile
+    try:
+        db = Database(dbfile,readonly=True)
+        for seriessetid in TimeSeriesSet.seriessetids(db):
+            tss = TimeSeriesSet(db,seriessetid)
+            for coeffid in tss.coeffids():
+                tss.loadcoefficients(db,coeffid).prefetch()
+    finally:
+        constants.profileDb = profiling
+    print '%s v%s: %s statements run' % (db.basename(),db.selectValue("SELECT MAX(number) FROM version"),len(Database.profile))
+    for sql in sorted(Database.profile):
+        scans = db.full_scans(sql)
+        if scans:
+            print '   %s\n      %s' % (sql,'; '.join(scans))
+    for tablename, leading, indexname, columns in db.missing_indexes():
+        print '   index %s(%s) is missing: run with --index to create it' % (tablename,','.join(leading))
+
 def utility():
     ConciseMonitor.enable(False)
     brief = False
+    check = False
     debug = False
+    index = False
     update = False
     default_dbfile = Application(None,"CoefficientMatrix Utility",False,True).dbFilePath
     dbfiles = [ ]
@@ -422,30 +611,52 @@ def utility():
             print 'options:'
             print ' -? --help            print the help information and exit'
             print ' -D --debug           turn on debugging'
+            print ' -I --index           migrate databases to schema v%s: create the missing lookup indexes and ANALYZE' % Database.migration[0]
             print ' -B --brief           brief display'
+            print ' -C --check           report the queries that scan whole tables instead of using an index'
             print ' -M --monitor         turn on resource monitoring'
+            print ' -P --profile         print the time spent per database query when done'
             print ' -U --update          update databases with any missing post-import coefficient matrices'
             sys.exit(1)
         elif arg == '-B' or arg == '--brief':
             brief = True
+        elif arg == '-C' or arg == '--check':
+            check = True
         elif arg == '-D' or arg == '--debug':
             debug = True
+        elif arg == '-I' or arg == '--index':
+            index = True
         elif arg == '-M' or arg == '--monitor':
             ConciseMonitor.enable(True)
+        elif arg == '-P' or arg == '--profile':
+            Application.the_app.root.constants.profileDb = True
         elif arg == '-U' or arg == '--update':
             update = True
         elif arg == '-D' or arg == '--debug':
             debug = True
         else:
-            Database(arg)   # raise exception now if not a valid db file
+            Database(arg,readonly=True)   # raise exception now if not a valid db file
             dbfiles.append(arg)
     if not dbfiles:
         dbfiles.append(default_dbfile)
     for dbfile in dbfiles:
+        if index:
+            db = Database(dbfile)
+            before = db.selectValue("SELECT MAX(number) FROM version")
+            if db.migrate():
+                print '%s: migrated from v%s to v%s' % (db.basename(),before,Database.migration[0])
+            elif before < Database.migration[0]:
+                print '%s v%s: *** not migrated, see the log' % (db.basename(),before)
+            db.close()
+        if check:
+            report_full_scans(dbfile)
+            continue
         resuse = ConciseMonitor()
         db = Database(dbfile)
         report_coefficients(db,brief,update)
         resuse.report('%s finished' % db.basename())
+    if getattr(Application.the_app.root.constants,'profileDb',False):
+        print Database.profile_report()
 
 if __name__ == '__main__':
     utility()
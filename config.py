@@ -29,6 +29,7 @@ class Config:
                 self._set_current_name(db,name)
 
     def _set_current_name(self,db,name):
+        if db.readonly(): return                    # a read-only session remembers nothing in the database
         db.execute("DELETE FROM config WHERE name=?",Config.NAME_OF_CURRENT)
         db.execute("INSERT INTO config(name,pickle) VALUES(?,?)",Config.NAME_OF_CURRENT,name)
 
@@ -36,6 +37,7 @@ class Config:
         return self._conf.keys()
 
     def store(self,db):
+        if db.readonly(): raise Exception, "Config(%s) cannot be stored in read-only database %s" % (self._name,db.filepath())
         db.execute("DELETE FROM config WHERE name=?",self._name)
         db.execute("INSERT INTO config(name,pickle) VALUES(?,?)",self._name,cPickle.dumps(self._conf))
         self._set_current_name(db,self._name)
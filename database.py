@@ -8,6 +8,23 @@
 #
 #       CAVEAT: transactions are the default for databases in python: don't forget to commit
 #
+#       Queries are only timed and logged when debugDb is on in the profile: each is logged
+#       as its SQL, params, row count and milliseconds, with the result itself only if it has
+#       at most Database.log_rows rows. Nothing is formatted when debugDb is off.
+#
+#       With profileDb on, the calls, rows, wall and cpu time of the queries are summed up
+#       per normalised statement, for Database.profile_report() on demand and in the log at
+#       exit. With slowQueryMs set, a query taking that long is logged with its query plan.
+#
+#       iterRows() and iterColumn() stream a result a batch at a time, where selectRows()
+#       and selectColumn() fetch all of it: use them for results that may be large.
+#
+#       Connections are tuned by the profile_defaults settings: page cache, memory map, temp
+#       tables in memory, and WAL if asked for. Database(file,readonly=True), or databaseReadOnly
+#       in the profile, opens for queries only. reader() lends a read-only connection from a
+#       pool, for threads that query while the main thread uses its own; close() and
+#       close_readers() close the pool.
+#
 #       Schema V4.000 (20110606)
 #
 #       CREATE TABLE coeff(coeffid INTEGER PRIMARY KEY AUTOINCREMENT, seriessetid INTEGER);
@@ -36,30 +53,111 @@
 #       CREATE UNIQUE INDEX coeffnorm_coeffid_seriesid1_seriesid2       ON coeffnorm       (coeffid,seriesid1,seriesid2);
 #       CREATE UNIQUE INDEX coeffinvertnorm_coeffid_seriesid1_seriesid2 ON coeffinvertnorm (coeffid,seriesid1,seriesid2);
 #
+#       Schema V4.043 (20261018) indexes for the loaders' lookups, added by migrate(), see coefficient.py --index,
+#       unless an index on the same leading columns is already there; then ANALYZE
+#
+#       CREATE INDEX coeff_seriessetid              ON coeff      (seriessetid);
+#       CREATE INDEX coeffvalue_coeffid             ON coeffvalue (coeffid);
+#       CREATE INDEX dict_client_clientid_key_value ON dict       (client,clientid,key,value);
+#       CREATE INDEX series_seriessetid             ON series     (seriessetid);
+#       CREATE INDEX time_seriessetid               ON time       (seriessetid);
+#       INSERT INTO version(number,date,description) VALUES(4.043,'20261018','indexes');
+#
 ############################################################################################
 
-import os, sqlite3, stat, sys
+import atexit, contextlib, os, re, sqlite3, stat, sys, threading, time
 
 from application import Application
 
 class Database:
 
-    def __init__(self,sqlite3file,*args):
+    def __init__(self,sqlite3file,*args,**options):
         must_exist = len(args) < 1 or not args[0]
         skip_version_check = len(args) < 2 or not args[1]
         if must_exist and not os.path.exists(sqlite3file): raise Exception, "Database: sqlite3 file %s not found" % sqlite3file
         self.app = Application.the_app
         self.sqlite3filepath = sqlite3file
-        self.conn = sqlite3.connect(sqlite3file)
+        self._args = args
+        readonly = options.get('readonly')                  # True: queries only, False: read-write, None: as set in the profile
+        self._readonly = self.setting('databaseReadOnly') if readonly is None else readonly
+        self.conn = sqlite3.connect(sqlite3file,check_same_thread=not options.get('pooled',False))
         self.curs = self.conn.cursor()
+        self._tune()
+        self._pool = [ ]                                    # idle read-only Databases on the same file, see reader(); None once close_readers()
+        self._pool_lock = threading.Lock()
+        self._pooled = options.get('pooled',False)
+        self._dictstore = None                              # the cache of the dict table, shared by the connections to the file, see DictStore.of()
+        self._cached = dict()                               # { name => value } computed once for this connection, see cached()
         if skip_version_check:
             self._version, self._versiondate, self._versiondescription = 0.0, os.stat(sqlite3file)[stat.ST_MTIME], "not a BC database"
         else:
             versiontablefound = self.selectColumn("SELECT name FROM sqlite_master WHERE type='table' AND name='version'")
             if len(versiontablefound) == 0: raise Exception, "Database file %s is not compatible - the version table is missing" % sqlite3file
-            for row in self.selectRows("SELECT number,date,description FROM version"):
+            for row in self.selectRows("SELECT number,date,description FROM version ORDER BY number"):
                 self._version, self._versiondate, self._versiondescription = row
-        self.log("Database: connected to sqlite3 database file %s, v%s" % (self.filepath(),self.version()))
+        self.log("Database: connected to sqlite3 database file %s, v%s%s",self.filepath(),self.version(),' read-only' if self.readonly() else '')
+
+    profile_defaults = dict(            # the connection profile, overridden by the settings of the same names in the profile
+        databaseReadOnly        = False,    # open for queries only
+        databaseCacheMegabytes  = 64,       # sqlite page cache per connection
+        databaseMmapMegabytes   = 256,      # read the file through a memory map of up to this size, 0 for none
+        databaseWal             = False,    # use write-ahead logging when writable: readers and the writer no longer block each other, but not for files on shared drives
+        )
+
+    def setting(self,name):
+        return getattr(self.app.root.constants,name,self.profile_defaults[name])
+
+    def _tune(self):                    # python 2 sqlite3 cannot open a read-only URI: open as usual, then make the connection query only
+        pragmas = [ "cache_size=%d" % -(self.setting('databaseCacheMegabytes') * 1024),
+                    "mmap_size=%d" % (self.setting('databaseMmapMegabytes') * 1024 * 1024),
+                    "temp_store=MEMORY" ]
+        if self._readonly:
+            pragmas.append("query_only=ON")
+        elif self.setting('databaseWal') and self.writable():
+            pragmas.append("journal_mode=WAL")
+        for pragma in pragmas:
+            self.conn.execute("PRAGMA %s" % pragma).fetchall()
+
+    def readonly(self):                 # True if opened for queries only, or if sqlite cannot write to the file
+        return not self.writable()
+
+    def writable(self):                 # True if sqlite can write to the file, which also needs to create its journal next to it
+        filepath = self.filepath()
+        directory = os.path.dirname(os.path.abspath(filepath))
+        if self._readonly or not os.access(directory, os.W_OK):
+            return False
+        return not os.path.exists(filepath) or os.access(filepath, os.W_OK)
+
+    pool_size = 4                       # idle read-only connections kept for reader()
+
+    @contextlib.contextmanager
+    def reader(self):                   # with db.reader() as readdb: a read-only Database on the same file for use by the current thread, from a pool
+        with self._pool_lock:
+            readdb = self._pool.pop() if self._pool else None
+        if readdb is None:
+            readdb = Database(self.filepath(),*self._args,readonly=True,pooled=True)
+        try:
+            yield readdb
+        finally:
+            with self._pool_lock:
+                if self._pool is not None and len(self._pool) < self.pool_size:
+                    self._pool.append(readdb)
+                    readdb = None
+            if readdb:
+                readdb.close()
+
+    def close_readers(self):            # close the pooled connections, and from now on those lent by reader() when they are given back
+        with self._pool_lock:
+            pool, self._pool = self._pool or [ ], None
+        for readdb in pool:
+            readdb.close()
+
+    def close(self):                    # close the connection and the pooled ones
+        self.close_readers()
+        self.conn.close()
+
+    def pooled(self):                   # True for a reader() connection
+        return self._pooled
 
     def connection(self):
         return self.conn
@@ -86,18 +184,100 @@ class Database:
         self.conn.commit()
 
     def execute(self,sql,*params):
-        self.log("Database.execute(%s,%s)" % (sql,list(params)))
-        self.curs.execute(sql,list(params))
+        self.execute_sans_commit(sql,*params)
         self.commit()
 
     def execute_sans_commit(self,sql,*params):                          # don't forget to call commit() when you are done
-        self.log("Database.execute(%s,%s)" % (sql,list(params)))
+        start = self._start()
         self.curs.execute(sql,list(params))
+        if start: self._finish('execute',sql,params,self.curs.rowcount,start)
+
+    def executemany_sans_commit(self,sql,rows):                        # don't forget to call commit() when you are done
+        start = self._start()
+        self.curs.executemany(sql,rows)
+        if start: self._finish('executemany',sql,(),len(rows),start)
+
+    def rollback(self):
+        self.conn.rollback()
+
+    log_rows = 10                       # query results of up to log_rows rows are logged in full, larger ones as a row count only
+
+    def debugging(self):                # True if database debugging is on: only then are queries logged
+        return getattr(self.app.root.constants,'debugDb',False)
+
+    def profiling(self):                # True if queries are profiled, see profile_report()
+        return getattr(self.app.root.constants,'profileDb',False)
+
+    def slowquery_ms(self):             # queries taking at least this many milliseconds are logged with their query plan; 0 for none
+        return getattr(self.app.root.constants,'slowQueryMs',0)
 
-    def log(self,message):
-            self.app.logdb(message)
+    def log(self,message,*args):        # message % args is only formatted if database debugging is on
+        if self.debugging():
+            self.app.logdb(message % args if args else message)
+
+    def _start(self):                   # the (wall, cpu) start time of a query that is logged or profiled, or None
+        if self.debugging() or self.profiling() or self.slowquery_ms():
+            return (time.time(), time.clock())
+        return None
+
+    def _finish(self,method,sql,params,rows,start):     # rows is the result, or the number of rows affected
+        wall = (time.time() - start[0]) * 1000
+        cpu = (time.clock() - start[1]) * 1000
+        if isinstance(rows,(int,long)):
+            nrows, result = rows, ''
+        else:
+            nrows, result = len(rows), ' = %s' % (rows,) if len(rows) <= self.log_rows else ''
+        if self.debugging():
+            self.app.logdb("Database.%s(%s,%s) %s rows %.1f ms%s" % (method,sql,list(params),nrows,wall,result))
+        if self.profiling():
+            key = self.normalised(sql)
+            with Database.profile_lock:
+                stats = Database.profile.setdefault(key,[0,0,0.0,0.0])
+                stats[0] += 1
+                stats[1] += max(nrows,0)
+                stats[2] += wall
+                stats[3] += cpu
+        threshold = self.slowquery_ms()
+        if threshold and wall >= threshold:
+            self.app.log("Database: slow query %.1f ms, %s rows in %s: %s %s\n%s" % (wall,nrows,self.basename(),sql,list(params),self.queryplan(sql,params)))
+
+    def queryplan(self,sql,params=()):  # the EXPLAIN QUERY PLAN of sql, one indented line per step
+        try:
+            steps = self.conn.execute("EXPLAIN QUERY PLAN %s" % sql,list(params)).fetchall()
+        except sqlite3.Error, e:
+            return '    no query plan: %s' % e
+        return '\n'.join('    %s' % ' '.join(str(column) for column in step) for step in steps)
+
+    profile = dict()                    # { normalised sql => [ calls, rows, wall ms, cpu ms ] } for all Databases when profiling
+    profile_lock = threading.Lock()
+
+    @staticmethod
+    def normalised(sql):                # sql with its literals replaced by ? and its whitespace collapsed, so that statements group together
+        sql = re.sub(r"'(?:[^']|'')*'","?",sql)
+        sql = re.sub(r"\b\d+(\.\d+)?\b","?",sql)
+        return ' '.join(sql.split())
+
+    @classmethod
+    def profile_report(cls,sortby='wall',reset=False):  # the profile as a table, most expensive statement first
+        columns = dict(calls=0,rows=1,wall=2,cpu=3)
+        with cls.profile_lock:
+            stats = sorted(cls.profile.items(),key=lambda item: item[1][columns[sortby]],reverse=True)
+            if reset:
+                cls.profile.clear()
+        lines = [ '%8s %10s %10s %10s %8s  %s' % ('calls','rows','wall ms','cpu ms','ms/call','sql') ]
+        for sql, (calls, rows, wall, cpu) in stats:
+            lines.append('%8d %10d %10.1f %10.1f %8.2f  %s' % (calls,rows,wall,cpu,wall/calls,sql))
+        lines.append('%8d %10d %10.1f %10.1f %8s  %s statements' % (sum(s[0] for q,s in stats),sum(s[1] for q,s in stats),
+            sum(s[2] for q,s in stats),sum(s[3] for q,s in stats),'',len(stats)))
+        return '\n'.join(lines)
+
+    @classmethod
+    def _report_profile_at_exit(cls):
+        if cls.profile and Application.the_app:
+            Application.the_app.log("Database profile:\n%s" % cls.profile_report())
 
     def selectValue(self,sql,*params):
+        start = self._start()
         self.curs.execute(sql,list(params))
         once = True
         row = [ None ]
@@ -105,32 +285,129 @@ class Database:
             if not once: raise Exception, "Database.selectValue(%s,%s) returned more than one row" % (sql,list(params))
             if len(row) > 1: raise Exception, "Database.selectValue(%s,%s) returned %s columns, not one" % (sql,list(params),len(row))
             once = False
-        if row != None:
-            self.log("Database.selectValue(%s,%s) = %s" % (sql,list(params), row[0]))
-        else:
-            self.log("Database.selectValue(%s,%s) returns nothing" % (sql,list(params)))
+        if start: self._finish('selectValue',sql,params,() if once else (row[0],),start)
         return row[0]
 
     def selectColumn(self,sql,*params):
+        start = self._start()
         self.curs.execute(sql,list(params))
         column = [ ]
         for row in self.curs.fetchall():
             if len(row) > 1: raise Exception, "Database.selectColumn(%s,%s) returned %s columns, not one" % (sql,list(params),len(row))
             column.append(row[0])
-        self.log("Database.selectColumn(%s,%s) = %s" % (sql,list(params), column))
-        return tuple(column)
+        column = tuple(column)
+        if start: self._finish('selectColumn',sql,params,column,start)
+        return column
 
     def selectRows(self,sql,*params):
+        start = self._start()
         self.curs.execute(sql,list(params))
         rows = self.curs.fetchall()
-        self.log("Database.selectRows(%s,%s) = %s" % (sql,list(params), rows))
+        if start: self._finish('selectRows',sql,params,rows,start)
         return rows
 
+    fetch_rows = 10000                  # rows fetched at a time by iterRows() and iterColumn()
+
+    def iterRows(self,sql,*params,**options):       # an iterator over the rows, fetched options['batch'] at a time; errors in sql are raised by the call itself
+        batch = options.pop('batch',self.fetch_rows)
+        if options: raise Exception, "Database.iterRows(%s,%s) unexpected options %s" % (sql,list(params),options.keys())
+        start = self._start()
+        curs = self.conn.cursor()                   # a cursor of its own, so that other queries can be made while iterating
+        curs.execute(sql,list(params))
+        return self._iterate('iterRows',curs,sql,params,batch,start)
+
+    def iterColumn(self,sql,*params,**options):     # an iterator over the values of a single column, fetched options['batch'] at a time
+        for row in self.iterRows(sql,*params,**options):
+            if len(row) > 1: raise Exception, "Database.iterColumn(%s,%s) returned %s columns, not one" % (sql,list(params),len(row))
+            yield row[0]
+
+    def _iterate(self,method,curs,sql,params,batch,start):
+        nrows = 0
+        try:
+            while True:
+                rows = curs.fetchmany(batch)
+                if not rows: break
+                nrows += len(rows)
+                if start: paused = (time.time(), time.clock())
+                for row in rows:
+                    yield row
+                if start: start = (start[0] + time.time() - paused[0], start[1] + time.clock() - paused[1])    # the time spent by the consumer is not the query's
+        finally:
+            curs.close()
+        if start: self._finish(method,sql,params,nrows,start)
+
     sequence_tablename = "sqlite_sequence"
 
     def sequenceid(self,tablename):     # returns the largest AUTOINCREMENT primary key for the given table
         return int(self.selectValue("SELECT seq FROM %s WHERE name=?" % self.sequence_tablename,tablename))
 
+    def cached(self,name,compute):      # compute() once per connection: nothing is written to the database, whose mtime keys the derived matrices' cache
+        if name not in self._cached:
+            self._cached[name] = compute()
+        return self._cached[name]
+
+    migration = (4.043, '20261018', 'indexes')    # the version row that migrate() adds
+
+    advised_indexes = [                 # (table, leading columns looked up, index name, indexed columns): coeffvalue, the largest table by far, only
+                                        # gets its lookup column indexed, the small dict table an index covering its loader's query
+        ('coeff',      ('seriessetid',),        'coeff_seriessetid',                ('seriessetid',)),
+        ('coeffvalue', ('coeffid',),            'coeffvalue_coeffid',               ('coeffid',)),
+        ('dict',       ('client','clientid'),   'dict_client_clientid_key_value',   ('client','clientid','key','value')),
+        ('series',     ('seriessetid',),        'series_seriessetid',               ('seriessetid',)),
+        ('time',       ('seriessetid',),        'time_seriessetid',                 ('seriessetid',)),
+    ]
+
+    def indexed_columns(self,tablename):    # a list of the column tuples of the indexes on tablename
+        indexes = [ ]
+        for row in self.selectRows("PRAGMA index_list(%s)" % tablename):
+            indexes.append(tuple(info[2] for info in self.selectRows("PRAGMA index_info(%s)" % row[1])))
+        return indexes
+
+    def missing_indexes(self):          # the advised_indexes whose leading columns are not indexed yet
+        schema = self.stored_schema()
+        missing = [ ]
+        for tablename, leading, indexname, columns in self.advised_indexes:
+            if tablename in schema and not any(indexed[:len(leading)] == leading for indexed in self.indexed_columns(tablename)):
+                missing.append((tablename, leading, indexname, columns))
+        return missing
+
+    def migrate(self):                  # bring a writable database older than the migration up to date; True if it was migrated
+                                        # this can take minutes on a large database, so it is never done on opening one: see coefficient.py --index
+        if self.readonly() or 'version' not in self.stored_schema():
+            return False
+        version = self.selectValue("SELECT MAX(number) FROM version")
+        if version is None or version >= self.migration[0]:
+            return False
+        start = time.time()
+        missing = self.missing_indexes()
+        isolation = self.conn.isolation_level
+        self.conn.isolation_level = None    # python 2 sqlite3 commits before each CREATE: run one explicit transaction so a failure undoes every index
+        try:
+            try:
+                self.execute_sans_commit("BEGIN")
+                for tablename, leading, indexname, columns in missing:
+                    self.execute_sans_commit("CREATE INDEX IF NOT EXISTS %s ON %s(%s)" % (indexname,tablename,','.join(columns)))
+                self.execute_sans_commit("ANALYZE")
+                self.execute_sans_commit("INSERT INTO version(number,date,description) VALUES(?,?,?)",*self.migration)
+                self.execute_sans_commit("COMMIT")
+            except sqlite3.Error, e:    # e.g. locked by another BC: the database is left as it was
+                try:
+                    self.execute_sans_commit("ROLLBACK")
+                except sqlite3.Error:
+                    pass                # BEGIN failed, there is nothing to roll back
+                self.app.log("Database: migration of %s to v%s failed: %s" % (self.basename(),self.migration[0],e))
+                return False
+        finally:
+            self.conn.isolation_level = isolation
+        self._version, self._versiondate, self._versiondescription = self.migration
+        self.app.log("Database: migrated %s from v%s to v%s in %.1f s, %s" % (self.basename(),version,self.migration[0],time.time()-start,
+            'created %s' % ' '.join(index[2] for index in missing) if missing else 'no indexes missing'))
+        return True
+
+    def full_scans(self,sql):           # the steps of sql's query plan that scan a whole table rather than search it through an index
+        steps = self.conn.execute("EXPLAIN QUERY PLAN %s" % sql,[ None ] * sql.count('?')).fetchall()
+        return [ step[-1] for step in steps if re.match(r"SCAN (TABLE )?\w+( AS \w+)?( \(~\d+ rows\))?$",step[-1]) ]
+
     def stored_schema(self):            # returns a dict of { tablename: None }
         schema = dict()
         # get sqlite tables: SELECT name FROM sqlite_master WHERE type='table' ORDER BY name
@@ -193,11 +470,110 @@ class Database:
         for row in rows:
             if row != addrbook[i]: raise Exception, "expected row[%s] to be %s in database %s - found %s" % (i,addrbook[i],dbfile,row)
             i += 1
-        db.commit()    
+        db.commit()
+
+        assert list(db.iterRows("SELECT * FROM addrbook ORDER BY name",batch=3)) == addrbook
+        names = db.iterColumn("SELECT name FROM addrbook WHERE name > ? ORDER BY name","b",batch=1)
+        assert names.next() == "doug" and db.selectValue("SELECT COUNT(*) FROM addrbook") == len(addrbook) and list(names) == ["johnno","rick"]
+        try:
+            db.iterRows("SELECT * FROM no_such_table")
+            assert False
+        except sqlite3.OperationalError:
+            pass
+
+        viewer = Database(app.testDbFilePath,readonly=True)
+        assert viewer.readonly() and not db.readonly() and viewer.selectValue("SELECT COUNT(*) FROM addrbook") == len(addrbook)
+        try:
+            viewer.execute("DELETE FROM addrbook")
+            assert False
+        except sqlite3.OperationalError:
+            pass
+        viewer.close()
+        with db.reader() as readdb:
+            assert readdb.readonly() and readdb.selectValue("SELECT COUNT(*) FROM addrbook") == len(addrbook)
+        with db.reader() as again:
+            assert again is readdb
+        counts = [ ]
+        def count():
+            with db.reader() as threaddb:
+                counts.append(threaddb.selectValue("SELECT COUNT(*) FROM addrbook"))
+        thread = threading.Thread(target=count)
+        thread.start()
+        thread.join()
+        assert counts == [len(addrbook)]
+
+        assert not db.migrate()                             # not a BC database
+
+        computed = [ ]
+        def compute():
+            computed.append(1)
+            return dict(answer=42)
+        db.execute("DROP TABLE IF EXISTS metadata")         # left by earlier versions of cached()
+        before = os.stat(app.testDbFilePath)
+        assert db.cached('test',compute) == dict(answer=42) and db.cached('test',compute) is db.cached('test',compute) and computed == [ 1 ]
+        after = os.stat(app.testDbFilePath)
+        assert (after.st_mtime, after.st_size) == (before.st_mtime, before.st_size) and 'metadata' not in db.stored_schema()
+        assert Database(app.testDbFilePath).cached('test',compute) == dict(answer=42) and computed == [ 1, 1 ]
+        olddbfile = app.testDbFilePath + ".v4"
+        if os.path.exists(olddbfile): os.remove(olddbfile)
+        conn = sqlite3.connect(olddbfile)
+        conn.executescript("CREATE TABLE version(number REAL, date TEXT, description TEXT); INSERT INTO version VALUES(4.0,'20110606','test');"
+            "CREATE TABLE series(seriesid INTEGER PRIMARY KEY AUTOINCREMENT, seriessetid INTEGER); CREATE INDEX series_ssid ON series(seriessetid);"
+            "CREATE TABLE time(timeid INTEGER PRIMARY KEY AUTOINCREMENT, seriessetid INTEGER, time TEXT);")
+        conn.executescript("CREATE TABLE dict(client TEXT, clientid INTEGER, key TEXT, value TEXT); CREATE TABLE time_seriessetid(x);")
+        conn.close()
+        olddb = Database(olddbfile,False,True)
+        assert olddb.version() == 4.0 and len(olddb.missing_indexes()) == 2
+        assert not olddb.migrate()                          # the table in the way of time_seriessetid fails the migration, and with it the dict index
+        assert olddb.version() == 4.0 and olddb.indexed_columns("dict") == [ ] and len(olddb.missing_indexes()) == 2
+        olddb.execute("DROP TABLE time_seriessetid")
+        assert olddb.migrate() and olddb.version() == Database.migration[0] and not olddb.missing_indexes() and not olddb.migrate()
+        assert olddb.selectValue("SELECT MAX(number) FROM version") == Database.migration[0]
+        assert olddb.indexed_columns("time") == [ ("seriessetid",) ] and olddb.indexed_columns("series") == [ ("seriessetid",) ]
+        assert not olddb.full_scans("SELECT time FROM time WHERE seriessetid=? ORDER BY timeid")
+        olddb.close()
+        os.remove(olddbfile)
+        assert len(db.full_scans("SELECT * FROM addrbook WHERE name=?")) == 1
+
+        assert Database.normalised("SELECT *  FROM addrbook\n WHERE name='o''neil' AND id=42") == "SELECT * FROM addrbook WHERE name=? AND id=?"
+        app.root.constants.profileDb = True
+        Database.profile.clear()
+        app.root.constants.slowQueryMs = 1e-6                   # every query is slow: each is logged with its query plan
+        logged = [ ]
+        app.log = logged.append
+        db.selectRows("SELECT * FROM addrbook WHERE name='andy'")
+        db.selectRows("SELECT * FROM addrbook WHERE name='rick'")
+        del app.log
+        app.root.constants.slowQueryMs = 0
+        assert Database.profile["SELECT * FROM addrbook WHERE name=?"][:2] == [2,2]
+        assert len(logged) == 2 and logged[1].startswith("Database: slow query ") and " 1 rows in %s: SELECT * FROM addrbook WHERE name='rick' []\n" % db.basename() in logged[1]
+        assert "addrbook" in logged[1].split("\n",1)[1]
+        report = Database.profile_report(reset=True)
+        if verbose: print report
+        lines = report.split("\n")
+        assert len(lines) == 3 and lines[1].split()[:2] == ["2","2"] and lines[1].endswith("  SELECT * FROM addrbook WHERE name=?")
+        assert lines[2].split()[:2] == ["2","2"] and lines[2].endswith(" 1 statements") and not Database.profile
+        assert "addrbook" in db.queryplan("SELECT * FROM addrbook WHERE name=?",["andy"])
+        app.root.constants.profileDb = False
+
+        with db.reader() as idle:
+            pass
+        with db.reader() as readdb:
+            assert readdb is idle
+            with db.reader() as lent:
+                db.close_readers()                          # e.g. the scenario is closed while a thread still reads
+                assert lent.selectValue("SELECT COUNT(*) FROM addrbook") == len(addrbook)
+        for closed in (idle, lent):
+            try:
+                closed.selectValue("SELECT COUNT(*) FROM addrbook")
+                assert False
+            except sqlite3.ProgrammingError:
+                pass
 
         print "Database okay"
 
-        
+
+atexit.register(Database._report_profile_at_exit)   # bc.py logs the profile itself, as it kills the process to quit
+
 if __name__ == '__main__':
     Database.tunit(len(sys.argv) > 1)
-
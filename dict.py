@@ -2,22 +2,33 @@
 
 ####################################################################################
 #
-#        Dict(db,classname,clientid)
+#        Dict(db,classname,clientid [,rows])      rows of (key,value) are used instead of querying the dict table
 #
 #        The above class mimics the interface and behaviour of its Java analogue
+#
+#        DictStore.of(db) caches the dict table of db: the first Dict of a class loads
+#        the dicts of all the objects of that class in one query, and later ones are
+#        copied from the cache. The cache is kept per database file: all the connections
+#        to a file, e.g. its db.reader() pool, share it, each querying on its own connection,
+#        and a put() or invalidate() on one is seen by the others. Opening a file anew,
+#        other than for the pool, starts its cache afresh, as the file may have changed.
+#        DictStore.put() writes to the dict table and the cache alike; after writing
+#        the dict or dictclient tables directly, call invalidate().
 #        
 ####################################################################################
 
-import sys
+import os, sys, threading
 from application import *
 from database import *
 
 class Dict(dict):
 
-    def __init__(self,db,classname,clientid):
-        client = self.clientOf(db,classname)            # TODO V5.000 rename client to clientnonce
-        for row in db.selectRows("SELECT key,value FROM dict WHERE client=? AND clientid=?",client,clientid):
-            self[row[0]] = row[1]
+    def __init__(self,db,classname,clientid,rows=None):
+        if rows is None:
+            self.update(DictStore.of(db).get(classname,clientid))
+        else:
+            for row in rows:
+                self[row[0]] = row[1]
 
     def get(self,key):          return self[key]
     def getint(self,key):       return int(self[key])
@@ -32,17 +43,9 @@ class Dict(dict):
         v = self[key].lower()
         return not (v=="0" or v=="false" or v=="no" or v=="off")
 
-    KNOWNCLASSES = None
-
     @staticmethod
     def clientOf(db,classname):
-        if Dict.KNOWNCLASSES == None:
-            Dict.KNOWNCLASSES = dict()
-            for row in db.selectRows("SELECT classname,client FROM dictclient"):
-                Dict.KNOWNCLASSES[row[0]] = row[1]
-            # print >>sys.stderr,"*Loaded Dict.KNOWNCLASSES=%s" % Dict.KNOWNCLASSES
-        if classname not in Dict.KNOWNCLASSES: raise Exception("classname %s not found in dictclient table for database %s" % (classname,db.filepath()))
-        return Dict.KNOWNCLASSES[classname]
+        return DictStore.of(db).client(classname)
 
     @staticmethod
     def tunit(verbose):
@@ -67,14 +70,95 @@ class Dict(dict):
         for key in tdict.keys():
             if verbose: print "insert(%s:%s:%s:%s=%s)" % (app.dbFilePath,client,clientid,key,tdict[key])
             db.execute("INSERT INTO dict(client,clientid,key,value) VALUES(?,?,?,?)",client,clientid,key,tdict[key])
+        DictStore.of(db).invalidate()
         d = Dict(db,classname,clientid)
         for key in tdict.keys():
             assert(key in d)
             assert(d[key] == tdict[key])
             if verbose: print "%s:%s:%s:%s=%s" % (app.dbFilePath,client,clientid,key,d[key])
 
+        store = DictStore.of(db)
+        assert store is DictStore.of(db) and Dict(db,classname,clientid+1) == {}
+        store.put(classname,clientid,'moveTime',4444)
+        assert Dict(db,classname,clientid)['moveTime'] == '4444' and Dict(db,classname,clientid+1) == {}
+        store.put(classname,clientid+1,'moveTime','5555')
+        assert Dict(db,classname,clientid+1) == { 'moveTime': '5555' }
+        db.execute("DELETE FROM dict WHERE client=? AND clientid=?",client,clientid+1)
+        store.invalidate()
+        assert Dict(db,classname,clientid+1) == {} and Dict(Database(app.dbFilePath),classname,clientid)['moveTime'] == '4444'
+        with db.reader() as readdb:                         # the pool shares db's cache, querying on its own connection
+            assert DictStore.of(readdb).db() is readdb and DictStore.of(readdb).dicts(classname) is store.dicts(classname)
+            store.put(classname,clientid,'moveTime',6666)
+            assert Dict(readdb,classname,clientid)['moveTime'] == '6666'
+            store.put(classname,clientid,'moveTime',4444)
+            DictStore.of(readdb).invalidate()
+            assert Dict(readdb,classname,clientid)['moveTime'] == '4444' and store.dicts(classname) is DictStore.of(readdb).dicts(classname)
+        try:
+            Dict.clientOf(db,'NoSuchClass')
+            assert False
+        except Exception, e:
+            assert 'NoSuchClass' in str(e)
+
         print "Dict okay"
 
+
+class DictStore(object):
+
+    caches = dict()                     # { database file realpath => the cache shared by its connections }
+    caches_lock = threading.Lock()
+
+    def __init__(self,db):
+        self._db = db
+        filepath = os.path.realpath(db.filepath())
+        with DictStore.caches_lock:
+            self._cache = DictStore.caches.setdefault(filepath,dict())  # clients: { classname => client } from the dictclient table, dicts: { classname => { clientid => Dict } }
+        if not self._cache or not db.pooled():
+            self.invalidate()
+
+    @staticmethod
+    def of(db):                         # the DictStore of db, created on first use, sharing the cache of db's file
+        if db._dictstore is None:
+            db._dictstore = DictStore(db)
+        return db._dictstore
+
+    def db(self):
+        return self._db
+
+    def client(self,classname):         # the client of classname in the dict table
+        clients = self._cache['clients']
+        if clients is None:
+            clients = self._cache['clients'] = dict(self._db.selectRows("SELECT classname,client FROM dictclient"))
+        if classname not in clients: raise Exception("classname %s not found in dictclient table for database %s" % (classname,self._db.filepath()))
+        return clients[classname]
+
+    def dicts(self,classname):          # { clientid => Dict } for every object of classname with a dict, loaded in one query; do not modify them
+        cached = self._cache['dicts']
+        if classname not in cached:
+            dicts = dict()
+            for clientid, key, value in self._db.iterRows("SELECT clientid,key,value FROM dict WHERE client=?",self.client(classname)):
+                if clientid not in dicts:
+                    dicts[clientid] = Dict(self._db,classname,clientid,())
+                dicts[clientid][key] = value
+            cached[classname] = dicts
+        return cached[classname]
+
+    def get(self,classname,clientid):   # the cached Dict of one object, empty if it has none; do not modify it, Dict(db,classname,clientid) is a copy
+        return self.dicts(classname).get(clientid,{})
+
+    def put(self,classname,clientid,key,value):     # store key=value in the dict of one object, in the database and in the cache
+        client = self.client(classname)
+        value = str(value)
+        self._db.execute_sans_commit("DELETE FROM dict WHERE client=? AND clientid=? AND key=?",client,clientid,key)
+        self._db.execute_sans_commit("INSERT INTO dict(client,clientid,key,value) VALUES(?,?,?,?)",client,clientid,key,value)
+        self._db.commit()
+        cached = self._cache['dicts']
+        if classname in cached:
+            cached[classname].setdefault(clientid,Dict(self._db,classname,clientid,()))[key] = value
+
+    def invalidate(self):               # forget everything cached for all the connections to the file, e.g. after writing the dict or dictclient tables directly
+        self._cache['clients'] = None
+        self._cache['dicts'] = dict()
+
 if __name__ == '__main__':
     Dict.tunit(len(sys.argv) > 1)
 
@@ -45,6 +45,9 @@ class GalaxyLayoutThread (QtCore.QThread):
         self.phasesByName = dict ()
         self.maxIndex = -1
         self.entryByStep = False
+        self.alphaCache = dict () # Node index -> bearing from the last layout
+        self.alphaCacheContext = None
+        self.warmStart = False
 
         for _index, _phase in enumerate (self.phases):
             self.displayPhaseSignal [_phase.__name__] = QtCore.Signal ()
@@ -420,6 +423,15 @@ class GalaxyLayoutThread (QtCore.QThread):
         if len (self.secondaryNodeIndexList):
             self.secondaryNode = self.secondaryNodeIndexList [0]
 
+            # Nodes that were laid out around the same center node before start from their last bearing; if they all were, adjustment
+            # only needs to fine tune
+            _context = (self.root.db.filepath (), self.root.N, self.root.centerNode ())
+            self.warmStart = _context == self.alphaCacheContext
+
+            if not self.warmStart:
+                self.alphaCache = dict ()
+                self.alphaCacheContext = _context
+
             for _nodeIndex in self.secondaryNodeIndexList:
                 _currentPosition = self.root.nodes [_nodeIndex].galaxy.previousEndpoint
 
@@ -429,7 +441,11 @@ class GalaxyLayoutThread (QtCore.QThread):
                     if _currentPosition.x () < 0.0:
                         self.alpha [_nodeIndex] -= math.pi
                 except:
-                    self.alpha [_nodeIndex] = random.uniform (0.0, 2.0 * math.pi) # Start with nodes with random alphae so when crosslink cutoff is max we have some spread
+                    if _nodeIndex in self.alphaCache:
+                        self.alpha [_nodeIndex] = self.alphaCache [_nodeIndex] # Hidden or cut off since it was last laid out
+                    else:
+                        self.alpha [_nodeIndex] = random.uniform (0.0, 2.0 * math.pi) # Start with nodes with random alphae so when crosslink cutoff is max we have some spread
+                        self.warmStart = False
 
                 _intensity = self.distance (_nodeIndex)
                 _alpha = self.alpha [_nodeIndex]
@@ -444,6 +460,7 @@ class GalaxyLayoutThread (QtCore.QThread):
         self.alphaDelta = 130.0 * self.DEGREES
         self.alphaDeltaReductionFactor = 0.7
         self.alphaDeltaSmallest = 5.0 * self.DEGREES
+        self.alphaDeltaWarm = 20.0 * self.DEGREES # Where to start when every node already has a bearing from the last layout
 
         self.nextStep ()
     def task_setupAdjustAllNodes (self):
@@ -451,7 +468,7 @@ class GalaxyLayoutThread (QtCore.QThread):
         #self.iterations = int (math.log10 (self.alphaDeltaSmallest / self.alphaDelta) / math.log10 (self.alphaDeltaReductionFactor)) + 1
         self.iteration = 0
         self.thisNode = 1 # This has to start at 1, not zero. We ignore the first value in the list
-        self.alphaDelta = 130.0 * self.DEGREES
+        self.alphaDelta = self.alphaDeltaWarm if self.warmStart else 130.0 * self.DEGREES
 
         if len (self.secondaryNodeIndexList):
             self.lastNode = self.secondaryNodeIndexList [-1]
@@ -479,6 +496,7 @@ class GalaxyLayoutThread (QtCore.QThread):
                 self.changesThisIteration = True
 
                 if self.alphaDelta < self.alphaDeltaSmallest:
+                    self.rememberAlphae ()
                     self.nextStep ()
                     return
                 else:
@@ -490,6 +508,7 @@ class GalaxyLayoutThread (QtCore.QThread):
                             self.iteration += 1
                             self.changesThisIteration = False
                         else:
+                            self.rememberAlphae ()
                             self.nextStep ()
                             return
                     else:
@@ -498,7 +517,11 @@ class GalaxyLayoutThread (QtCore.QThread):
 
             self.repeatStep ()
         else:
+            self.rememberAlphae ()
             self.nextStep ()
+    def rememberAlphae (self):
+        for _nodeIndex in self.secondaryNodeIndexList:
+            self.alphaCache [_nodeIndex] = self.alpha [_nodeIndex]
     def task_noLongerWorking (self):
         if not self.enterThisFunction (): return
         self.nextStep ()
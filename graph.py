@@ -13,20 +13,25 @@
 
 import math
 import igraph
+import numpy
 import time
 from PySide.QtCore import QPointF
 from monitor import ConciseMonitor
 
 class FruchtermanReingold ():
     def __init__ (self, application, view, coefficients, initialPositions, checkInterruptFunction = None, messageItem = None, \
-                    recenter = True, maximumIterations = 100, minimumKineticEnergy = 0.01, damping = 0.9, forceFactor = 0.25):
+                    recenter = True, maximumIterations = 100, minimumKineticEnergy = 0.01, damping = 0.9, forceFactor = 0.25, \
+                    exactNodeCount = 1000, theta = 1.0, moving = None):
+        # The positions and velocities are (n, 2) arrays. The first iteration moves every node at once from the forces of the initial positions;
+        # after that each node moves in turn, its force taking in the nodes moved before it in the same iteration, as the QPointF engine did.
+        # Above exactNodeCount nodes every iteration moves every node at once, the forces of distant nodes being approximated to within theta,
+        # see approximateForces ()
+        # moving lists the nodes to relax; the others stay at their initial positions. None relaxes every node, see LayoutCache
         _sizeError = Exception ('The sizes of the two arguments do not match')
         _emptyError = Exception ('The coefficients matrix is empty')
         _nodeCount = len (coefficients)
         self.coefficients = coefficients
-        _origin = QPointF (0, 0)
         _iteration = 0
-        _velocities = [_origin] * _nodeCount
         self.interimPositions = []
         self.finalPositions = []
         self.maximumValue = -1
@@ -38,16 +43,23 @@ class FruchtermanReingold ():
             raise _emptyError
 
         _forceFactorMultiplier = forceFactor / _nodeCount
+        _interruptFunction = checkInterruptFunction or self.dummyCheckInterruptFunction
+        _approximate = _nodeCount > exactNodeCount
+        _movingNodes = range (_nodeCount) if moving is None else sorted (moving)
+        _fixed = numpy.ones (_nodeCount, dtype = bool)
+        _fixed [_movingNodes] = False
+
+        if _approximate:
+            self.links = self.coefficientLinks (coefficients)
+        else:
+            self.magnitudes = self.coefficientMagnitudes (coefficients)
+            self.selfMagnitudes = self.magnitudes.diagonal ().copy ()
 
-        try:
-            _interruptFunction = checkInterruptFunction
-        except:
-            _interruptFunction = dummyCheckInterruptFunction
-
-        for i in range (_nodeCount):
-            self.interimPositions.append (QPointF (initialPositions [i]))
-            self.finalPositions.append (QPointF (self.interimPositions [i]))
+        _positions = numpy.array ([(_position.x (), _position.y ()) for _position in initialPositions], dtype = numpy.float64)
+        _velocities = numpy.zeros ((_nodeCount, 2))
+        self.store (_positions)
 
+        _previousKineticEnergy = 0.0
         _firstIteration = True
         _displayProgress = False
         _maxPercentageComplete = 0.0
@@ -55,33 +67,40 @@ class FruchtermanReingold ():
         while True:
             if _interruptFunction ():
                 self.interrupted = True
+                self.store (_positions)
                 return
 
             _loopStartTime = time.time ()
-            _totalKineticEnergy = 0.0
             _iteration += 1
 
-            for _node1Index, _vector in enumerate (self.interimPositions):
-                if _interruptFunction ():
-                    self.interrupted = True
-                    return
-
-                _netForce = QPointF (0, 0)
-
-                for _node2Index, _node in enumerate (self.interimPositions):
-                    if _node1Index != _node2Index:
-                        _netForce += self.hooke (_node1Index, _node2Index)
-
-                _velocities [_node1Index] = (_velocities [_node1Index] + _netForce * _forceFactorMultiplier) * damping
-                v = _velocities [_node1Index]
-                vx = v.x ()
-                vy = v.y ()
-                _totalKineticEnergy += vx * vx + vy * vy
-                self.finalPositions [_node1Index] -= v
-
-            self.interimPositions = self.finalPositions [:]
-
-            if _totalKineticEnergy < minimumKineticEnergy:
+            if _approximate:
+                _velocities = (_velocities + self.approximateForces (_positions, theta) * _forceFactorMultiplier) * damping
+                _velocities [_fixed] = 0.0
+                _positions -= _velocities
+            elif _iteration == 1:
+                _velocities = (_velocities + self.forces (_positions) * _forceFactorMultiplier) * damping
+                _velocities [_fixed] = 0.0
+                _positions -= _velocities
+            else:
+                _x = _positions [:, 0]
+                _y = _positions [:, 1]
+
+                for _node1Index in _movingNodes:
+                    if _interruptFunction ():
+                        self.interrupted = True
+                        self.store (_positions)
+                        return
+
+                    _forceX, _forceY = self.force (_x, _y, _node1Index)
+                    _velocities [_node1Index, 0] = _vx = (_velocities [_node1Index, 0] + _forceX * _forceFactorMultiplier) * damping
+                    _velocities [_node1Index, 1] = _vy = (_velocities [_node1Index, 1] + _forceY * _forceFactorMultiplier) * damping
+                    _x [_node1Index] -= _vx
+                    _y [_node1Index] -= _vy
+
+            _totalKineticEnergy = float ((_velocities * _velocities).sum ())
+
+            # A few moving nodes starting from rest speed up before they slow down, so a warm start only stops once they are slowing
+            if _totalKineticEnergy < minimumKineticEnergy and (moving is None or _totalKineticEnergy <= _previousKineticEnergy):
                 self.totalIterations = _iteration
                 self.totalFinalKineticEnergy =  _totalKineticEnergy
                 break
@@ -91,6 +110,8 @@ class FruchtermanReingold ():
                 self.totalFinalKineticEnergy =  _totalKineticEnergy
                 break
 
+            _previousKineticEnergy = _totalKineticEnergy
+
             if messageItem:
                 _percentageComplete = min (100, 100.0 * math.sqrt (minimumKineticEnergy / _totalKineticEnergy))
                 _maxPercentageComplete = max (_maxPercentageComplete, _percentageComplete)
@@ -111,7 +132,176 @@ class FruchtermanReingold ():
                     application.processEvents ()
 
         if recenter:
-            self.recenter (self.finalPositions)
+            _positions -= _positions.mean (axis = 0)
+
+        self.store (_positions)
+    def coefficientMagnitudes (self, coefficients):
+        # magnitudes [i, j] is the spring length between nodes i and j: 1 - abs (coefficients [i] [j]), or 1 where there is no coefficient
+        _nodeCount = len (coefficients)
+        _magnitudes = numpy.ones ((_nodeCount, _nodeCount))
+
+        for i, _coefficientVector in enumerate (coefficients):
+            for j in _coefficientVector:
+                _magnitudes [i, j] = 1.0 - abs (_coefficientVector [j])
+
+        return _magnitudes
+    def coefficientLinks (self, coefficients):
+        # The (rows, columns, abs (coefficients)) arrays of the coefficients off the diagonal, for approximateForces ()
+        _rows = []
+        _columns = []
+        _values = []
+
+        for i, _coefficientVector in enumerate (coefficients):
+            for j in _coefficientVector:
+                if j != i:
+                    _rows.append (i)
+                    _columns.append (j)
+                    _values.append (abs (_coefficientVector [j]))
+
+        return numpy.array (_rows, dtype = numpy.int64), numpy.array (_columns, dtype = numpy.int64), numpy.array (_values, dtype = numpy.float64)
+    def forces (self, positions):
+        # The net hooke () force on every node from all the other nodes, as an (n, 2) array
+        _deltas = positions [numpy.newaxis, :, :] - positions [:, numpy.newaxis, :]
+        _distances = numpy.sqrt ((_deltas * _deltas).sum (axis = 2))
+        _coincident = _distances == 0
+        _weights = self.magnitudes / numpy.where (_coincident, 1.0, _distances)
+        _forces = (_weights [:, :, numpy.newaxis] * _deltas).sum (axis = 1) - _deltas.sum (axis = 1)
+
+        # hooke () pulls a node straight down towards a node at its very position, and every node is at its own position
+        _forces [:, 1] -= numpy.where (_coincident, self.magnitudes, 0.0).sum (axis = 1) - self.selfMagnitudes
+        return _forces
+    def force (self, x, y, node):
+        # The net hooke () force on one node from all the other nodes, as a tuple
+        _deltaX = x - x [node]
+        _deltaY = y - y [node]
+        _distances = numpy.hypot (_deltaX, _deltaY)
+        _distances [node] = numpy.inf
+        _coincident = _distances == 0
+        _weights = self.magnitudes [node] / numpy.where (_coincident, 1.0, _distances) - 1.0
+        _forceX = float (numpy.dot (_weights, _deltaX))
+        _forceY = float (numpy.dot (_weights, _deltaY))
+
+        # hooke () pulls a node straight down towards a node at its very position
+        if _coincident.any ():
+            _forceY -= float (self.magnitudes [node] [_coincident].sum ())
+
+        return _forceX, _forceY
+    def approximateForces (self, positions, theta):
+        # The net hooke () force on every node, as an (n, 2) array, in O(n log n) time and memory rather than O(n^2). The force on node i is
+        #
+        #   sum over j of (1 - abs (c [i, j])) * unit (p [j] - p [i]) - (p [j] - p [i])
+        #
+        # The sum of the deltas is exact from the sum of the positions, and so are the coefficient terms from the links. The sum of the unit
+        # vectors is approximated by unitVectorSums ()
+        _nodeCount = len (positions)
+        _forces = _nodeCount * positions - positions.sum (axis = 0)
+        _rows, _columns, _values = self.links
+        _unitX, _unitY = self.unitVectors (positions [_columns, 0] - positions [_rows, 0], positions [_columns, 1] - positions [_rows, 1])
+        _forces [:, 0] -= numpy.bincount (_rows, _values * _unitX, minlength = _nodeCount)
+        _forces [:, 1] -= numpy.bincount (_rows, _values * _unitY, minlength = _nodeCount)
+        return _forces + self.unitVectorSums (positions, theta)
+    leafNodes = 4                       # unitVectorSums () divides the layout into cells until they hold about this many nodes on average
+    pairsAtOnce = 1000000               # and works out the exact unit vectors between nodes in neighbouring cells this many at a time
+    def unitVectorSums (self, positions, theta):
+        # The sum of the unit vectors from each node to every other node, as an (n, 2) array, Barnes-Hut style. The layout is covered by a
+        # quadtree of grids, from 4 x 4 cells down to cells of about leafNodes nodes. The cells within the neighbourhood of a node's own cell,
+        # of radius 1 / theta cells, are looked into at the next level down; the cells beyond it count as their number of nodes at their
+        # centroid, a cell's size being at most theta times its distance. At the bottom the nodes of the neighbouring cells count exactly
+        _nodeCount = len (positions)
+        _radius = min (max (1, int (math.ceil (1.0 / theta))), 4)       # theta from 0.25 up, smaller is no more accurate than 0.25
+        _depth = 20
+        _lowest = positions.min (axis = 0)
+        _span = max (float ((positions.max (axis = 0) - _lowest).max ()), 1e-12)
+        _cells = numpy.floor ((positions - _lowest) * ((1 << _depth) / _span)).astype (numpy.int64).clip (0, (1 << _depth) - 1)
+        _distinct = len (numpy.unique (_cells [:, 0] << _depth | _cells [:, 1]))     # the cells cannot separate the nodes any further
+        _sums = numpy.zeros ((_nodeCount, 2))
+
+        for _level in range (2, _depth + 1):
+            _size = 1 << _level
+            _offsetsX, _offsetsY = self.farCells (min (_radius, _size / 2 - 1), min (_radius, _size - 1))
+            _cellX = _cells [:, 0] >> (_depth - _level)
+            _cellY = _cells [:, 1] >> (_depth - _level)
+            _keys, _cell = numpy.unique (_cellX * _size + _cellY, return_inverse = True)
+            _counts = numpy.bincount (_cell)
+            _centroidX = numpy.bincount (_cell, positions [:, 0]) / _counts
+            _centroidY = numpy.bincount (_cell, positions [:, 1]) / _counts
+            _parity = (_cellX & 1) * 2 + (_cellY & 1)
+            _far, _found = self.findCells (_keys, _size, _cellX [:, numpy.newaxis] + _offsetsX [_parity], _cellY [:, numpy.newaxis] + _offsetsY [_parity])
+            _weights = numpy.where (_found, _counts [_far], 0)
+            _unitX, _unitY = self.unitVectors (_centroidX [_far] - positions [:, 0, numpy.newaxis], _centroidY [_far] - positions [:, 1, numpy.newaxis])
+            _sums [:, 0] += (_weights * _unitX).sum (axis = 1)
+            _sums [:, 1] += (_weights * _unitY).sum (axis = 1)
+
+            if (_counts * _counts).sum () <= self.leafNodes * _nodeCount or len (_keys) == _distinct:
+                break
+
+        # The nodes of the cells in the neighbourhood of each node's own cell at the bottom level, in pairsAtOnce chunks
+        _order = numpy.argsort (_cell, kind = 'mergesort')
+        _starts = numpy.concatenate (([0], numpy.cumsum (_counts) [:-1]))
+        _near = numpy.arange (-_radius, _radius + 1)
+        _nearX, _nearY = [_offset.ravel () for _offset in numpy.meshgrid (_near, _near, indexing = 'ij')]
+        _neighbour, _found = self.findCells (_keys, _size, _cellX [:, numpy.newaxis] + _nearX, _cellY [:, numpy.newaxis] + _nearY)
+        _pairCounts = numpy.where (_found, _counts [_neighbour], 0)
+        _nodePairs = numpy.cumsum (_pairCounts.sum (axis = 1))
+        _first = 0
+
+        while _first < _nodeCount:
+            _last = max (_first + 1, int (numpy.searchsorted (_nodePairs, (_nodePairs [_first - 1] if _first else 0) + self.pairsAtOnce, side = 'right')))
+            _lengths = _pairCounts [_first:_last].ravel ()
+            _segments = numpy.repeat (numpy.arange (len (_lengths)), _lengths)
+            _segmentStarts = numpy.cumsum (_lengths) - _lengths
+            _node1 = _first + _segments // len (_nearX)
+            _node2 = _order [_starts [_neighbour [_first:_last].ravel ()] [_segments] + numpy.arange (len (_segments)) - _segmentStarts [_segments]]
+            _other = _node1 != _node2
+            _node1 = _node1 [_other]
+            _node2 = _node2 [_other]
+            _unitX, _unitY = self.unitVectors (positions [_node2, 0] - positions [_node1, 0], positions [_node2, 1] - positions [_node1, 1])
+            _sums [:, 0] += numpy.bincount (_node1, _unitX, minlength = _nodeCount)
+            _sums [:, 1] += numpy.bincount (_node1, _unitY, minlength = _nodeCount)
+            _first = _last
+
+        return _sums
+    @staticmethod
+    def farCells (parentRadius, radius):
+        # The cells beyond a node's neighbourhood at a level, but within its parent's neighbourhood at the level above, as (4, k) arrays
+        # of x and y offsets from the node's cell for each of the four positions of a cell within its parent
+        _around = numpy.arange (-2 * parentRadius, 2 * parentRadius + 2)
+        _offsetsX = []
+        _offsetsY = []
+
+        for _parity in range (4):
+            _offsetX, _offsetY = numpy.meshgrid (_around - (_parity >> 1), _around - (_parity & 1), indexing = 'ij')
+            _beyond = numpy.maximum (abs (_offsetX), abs (_offsetY)) > radius
+            _offsetsX.append (_offsetX [_beyond])
+            _offsetsY.append (_offsetY [_beyond])
+
+        return numpy.array (_offsetsX), numpy.array (_offsetsY)
+    denseCells = 1 << 20                # findCells () looks cells up in a table rather than searching the keys on grids of up to this many cells
+    def findCells (self, keys, size, cellX, cellY):
+        # The indexes into the sorted keys of the cells (cellX, cellY) of a size x size grid, and whether they were found: empty cells are not
+        _inside = (cellX >= 0) & (cellX < size) & (cellY >= 0) & (cellY < size)
+        _wanted = numpy.where (_inside, cellX * size + cellY, 0)
+
+        if size * size <= self.denseCells:
+            _table = numpy.zeros (size * size, dtype = numpy.int64) - 1
+            _table [keys] = numpy.arange (len (keys))
+            _indexes = _table [_wanted]
+            _found = _inside & (_indexes >= 0)
+        else:
+            _indexes = numpy.searchsorted (keys, _wanted).clip (0, len (keys) - 1)
+            _found = _inside & (keys [_indexes] == _wanted)
+
+        return numpy.where (_found, _indexes, 0), _found
+    @staticmethod
+    def unitVectors (deltaX, deltaY):
+        # The unit vectors along the deltas, straight down for a zero delta as in hooke ()
+        _distances = numpy.hypot (deltaX, deltaY)
+        _zero = _distances == 0
+        _distances [_zero] = 1.0
+        return deltaX / _distances, numpy.where (_zero, -1.0, deltaY / _distances)
+    def store (self, positions):
+        self.finalPositions = [QPointF (_x, _y) for _x, _y in positions.tolist ()]
+        self.interimPositions = self.finalPositions [:]
     def wasInterrupted (self):
         return self.interrupted
     def dummyCheckInterruptFunction (self):
@@ -159,6 +349,49 @@ class FruchtermanReingold ():
         _coeff = QPointF (_coeffX, _coeffY)
         return _coeff - _delta
 
+class LayoutCache ():
+    # Remembers where a layout put each node, so a rerun can start from there. An item of the layout is a group of node indices and is
+    # known by its set of members; an item whose members and coefficients to the other items are unchanged since the last layout stays
+    # where it was, any other item starts at the mean of its members' last positions and is relaxed by FruchtermanReingold
+    def __init__ (self):
+        self.reset ()
+    def reset (self, context = None):
+        # context identifies what the node indices refer to, e.g. the database; the cache empties itself when it changes
+        self.context = context
+        self.positions = dict () # Node index -> (x, y)
+        self.items = dict () # Set of members -> {set of members of another item: coefficient}
+    def rows (self, groups, coefficients):
+        _keys = [frozenset (_group) for _group in groups]
+        return _keys, [dict ((_keys [j], _coefficientVector [j]) for j in _coefficientVector) for _coefficientVector in coefficients]
+    def start (self, groups, coefficients, defaults, context = None):
+        # Returns the initial positions of the items and the list of the items to relax
+        if context != self.context:
+            self.reset (context)
+
+        _keys, _rows = self.rows (groups, coefficients)
+        _initialPositions = []
+        _moving = []
+
+        for i, _key in enumerate (_keys):
+            _known = [self.positions [_node] for _node in _key if _node in self.positions]
+
+            if _known:
+                _initialPositions.append (QPointF (sum (_x for _x, _y in _known) / len (_known), sum (_y for _x, _y in _known) / len (_known)))
+            else:
+                _initialPositions.append (QPointF (defaults [i]))
+
+            if len (_known) != len (_key) or self.items.get (_key) != _rows [i]:
+                _moving.append (i)
+
+        return _initialPositions, _moving
+    def store (self, groups, coefficients, positions):
+        _keys, _rows = self.rows (groups, coefficients)
+        self.items = dict (zip (_keys, _rows))
+
+        for _key, _position in zip (_keys, positions):
+            for _node in _key:
+                self.positions [_node] = (_position.x (), _position.y ())
+
 # Lays out the coeffs list in a spiral
 class Spiral ():
     def __init__ (self, nodeCount, scaling = 1.0, cutoff = 1):
@@ -187,7 +420,9 @@ class Spiral ():
         return self.nodes
 
 class FruchtermanReingoldIgraph ():
-    def __init__(self, links, scaling = 1):
+    def __init__(self, links, scaling = 1, threshold = 0.0):
+        # links is a lower triangle of coefficients, e.g. a CoefficientMatrix or a list of dict or list rows; the graph has an edge for
+        # each of its non-zero coefficients, and only for those of at least threshold in magnitude when there is a threshold
         resource_usage = ConciseMonitor()
         self._scaling = scaling
         self._size = len (links)
@@ -195,23 +430,19 @@ class FruchtermanReingoldIgraph ():
 
         # initialise the igraph.Graph
         _ig = igraph.Graph (self._size)
-        _weights = []
+        _rows, _columns, _coefficients = self.sparseLinks (links)
+        _kept = (_coefficients != 0) & (abs (_coefficients) >= threshold)
+        _ig.add_edges (zip (_rows [_kept].tolist (), _columns [_kept].tolist ()))
+        _weights = 1000.0 * _coefficients [_kept]
 
-        for i in range (self._size):
-            for j in range (i):
-                _ig.add_edges ((i, j))
-                _corr = self.getLink (i, j)
-                _w = int (1000 * _corr)
-                _weights.append (_w)
-
-        resource_usage.report ('      FruchtermanReingold: weights')
+        resource_usage.report ('      FruchtermanReingold: %d edges' % _ig.ecount ())
         x = []
         for i in range (self._size):
             _alpha = i * math.pi * 2 / self._size
-            x.append (10 * [math.cos (_alpha), 10 * math.sin (_alpha)])
+            x.append ([10 * math.cos (_alpha), 10 * math.sin (_alpha)])
 
         resource_usage.report ('      FruchtermanReingold: initial positions')
-        _coordinates = self.recentre (_ig.layout_fruchterman_reingold (seed = x, weights = _weights, repulserad = 10))
+        _coordinates = self.recentre (_ig.layout_fruchterman_reingold (seed = x, weights = _weights.tolist (), repulserad = 10))
         resource_usage.report ('      FruchtermanReingold: recentre')
         _maxValue = 0.0
 
@@ -237,6 +468,24 @@ class FruchtermanReingoldIgraph ():
                 self._nodes.append (_p)
 
         resource_usage.report ('      FruchtermanReingold on %d nodes complete' % (self._size))
+    def sparseLinks (self, links):
+        # The (rows, columns, coefficients) arrays of the links below the diagonal, leaving out the missing ones of sparse rows
+        if hasattr (links, 'indptr'):
+            _rows = numpy.repeat (numpy.arange (len (links), dtype = numpy.int64), numpy.diff (links.indptr))
+            _columns = numpy.asarray (links.indices, dtype = numpy.int64)
+            _coefficients = numpy.asarray (links.data, dtype = numpy.float64)
+        else:
+            _cells = []
+
+            for i, _row in enumerate (links):
+                _items = _row.items () if hasattr (_row, 'items') else enumerate (_row)
+                _cells.extend ((i, j, _coefficient) for j, _coefficient in _items if j < i)
+
+            _cells = numpy.array (_cells, dtype = numpy.float64).reshape (-1, 3)
+            _rows, _columns, _coefficients = _cells [:, 0].astype (numpy.int64), _cells [:, 1].astype (numpy.int64), _cells [:, 2]
+
+        _lower = _columns < _rows
+        return _rows [_lower], _columns [_lower], _coefficients [_lower]
     def getLink (self, i, j):
         if i > j:
             return self._links [i] [j]
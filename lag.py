@@ -9,6 +9,7 @@ from dateutil.relativedelta import *
 import math
 import re
 import random
+from timeseries import nullable
 
 import PySide.QtCore as QtCore
 import PySide.QtGui as QtGui
@@ -805,9 +806,4 @@ class LagPlot (QtGui.QScrollArea):
         self.resize (QtCore.QSize (self.size () + QtCore.QSize (1, 0)))
         self.resize (QtCore.QSize (self.size () + QtCore.QSize (-1, 0)))
     def makeIntoList (self, thing, length):
-        _list = []
-
-        for i in range (length):
-            _list.append (thing [i])
-
-        return _list
+        return nullable (thing, length)
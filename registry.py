@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+
+####################################################################################
+#
+#       Registry(budget): a process-wide, reference-counted cache of loaded objects
+#
+#       Objects are keyed by (database path, seriessetid, coeffid), where coeffid
+#       is None for a TimeSeriesSet. acquire() returns the registered object for
+#       a key, loading it on a miss, and counts a reference to it; release()
+#       drops the reference. An object without references stays registered, so
+#       coming back to it is free, until the registry grows over its budget in
+#       bytes: then the least recently used unreferenced objects are evicted.
+#
+#       Registered objects report their size with nbytes(). An entry may depend
+#       on other entries, e.g. Coefficients on their TimeSeriesSet: the entry
+#       holds a reference on each dependency until it is evicted.
+#
+#       the_registry is the process-wide Registry; acquire_timeseriesset() and
+#       acquire_coefficients() load through it.
+#
+#       preload(db, seriessetids) loads the TimeSeriesSets and their current
+#       Coefficients into the_registry all at once, in the pool of processes made
+#       by start_preload_pool() before Qt starts, each seriessetid on a read-only
+#       connection of its own. The processes return TimeSeriesSet.payload()s of
+#       plain rows and arrays, from which the TimeSeriesSets are assembled here.
+#
+#       Prefetcher(db, plan) is a thread that loads the plan's TimeSeriesSets and
+#       Coefficients into the_registry on a db.reader() connection, and then hands
+#       them over to db. It stops when cancelled or when the registry is near its
+#       budget.
+#
+####################################################################################
+
+import collections, multiprocessing, os, shutil, sys, threading
+
+from application import Application
+from database import Database
+from monitor import ConciseMonitor
+from timeseries import TimeSeriesSet
+from coefficient import Coefficients, derived_matrix_tablenames
+
+
+class Registry(object):
+
+    def __init__(self, budget=512*1024*1024):
+        self.budget = budget                                # bytes held by all the objects, referenced or not, before unreferenced ones are evicted
+        self._entries = collections.OrderedDict()           # key => [ object, refcount, dependencies ], least recently used first
+        self._lock = threading.RLock()
+        self._loading = set()                               # keys being loaded, outside the lock
+        self._loaded = threading.Condition(self._lock)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def acquire(self, key, loader, dependencies=()):        # the object for key, loaded by loader() on a miss; the caller hands over a reference on each dependency
+        with self._lock:
+            while key in self._loading:                     # another thread is loading it
+                self._loaded.wait()
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.hits += 1
+                for dependency in dependencies:             # the registered entry already holds its own references
+                    self._release(dependency)
+                entry[1] += 1
+                self._entries[key] = entry
+                return entry[0]
+            self._loading.add(key)
+        try:                                                # load without the lock, so that other keys can be acquired meanwhile
+            obj = loader()
+        except:
+            with self._lock:
+                self._loading.discard(key)
+                self._loaded.notify_all()
+                for dependency in dependencies:
+                    self._release(dependency)
+            raise
+        with self._lock:
+            self._loading.discard(key)
+            self._loaded.notify_all()
+            self.misses += 1
+            self._entries[key] = [ obj, 1, tuple(dependencies) ]
+            self._evict()
+            return obj
+
+    def release(self, key):
+        with self._lock:
+            self._release(key)
+            self._evict()
+
+    def lookup(self, key):                                  # the object for key or None, without loading it or counting a reference
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry else None
+
+    def refcount(self, key):
+        with self._lock:
+            return self._entries[key][1] if key in self._entries else 0
+
+    def keys(self):
+        with self._lock:
+            return self._entries.keys()
+
+    def nbytes(self):
+        with self._lock:
+            return sum(entry[0].nbytes() for entry in self._entries.values())
+
+    def discard(self, dbpath):                              # forget the unreferenced objects of a database that is no longer in use
+        with self._lock:
+            dbpath = registry_path(dbpath)
+            found = True
+            while found:
+                found = False
+                for key, entry in self._entries.items():
+                    if key[0] == dbpath and entry[1] == 0:
+                        self._remove(key)
+                        found = True
+
+    def report(self):
+        return 'Registry %s objects %.1fM of %.1fM budget, %s hits %s misses %s evictions' % (len(self._entries),
+            self.nbytes()/1048576.0, self.budget/1048576.0, self.hits, self.misses, self.evictions)
+
+    def _release(self, key):
+        entry = self._entries[key]
+        if entry[1] <= 0: raise Exception, "Registry: release of %s without a reference" % (key,)
+        entry[1] -= 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        for dependency in entry[2]:
+            self._release(dependency)
+
+    def _evict(self):                                       # while over budget, evict unreferenced objects: the referenced ones count towards the budget too,
+                                                            # so when they alone exceed it, no unreferenced object stays registered
+        total = self.nbytes()
+        evicted = True
+        while total > self.budget and evicted:
+            evicted = False
+            for key, entry in self._entries.items():        # least recently used first
+                if entry[1] == 0:
+                    total -= entry[0].nbytes()
+                    self._remove(key)
+                    self.evictions += 1
+                    evicted = True
+                    break
+
+    @staticmethod
+    def tunit(verbose):
+
+        class Loaded(object):
+            def __init__(self, size):   self.size = size
+            def nbytes(self):           return self.size
+
+        loads = []
+        def loader(size):
+            def load():
+                loads.append(size)
+                return Loaded(size)
+            return load
+
+        reg = Registry(budget=100)
+        db = registry_path('T.db')
+        a = reg.acquire((db, 1, None), loader(40))
+        assert reg.acquire((db, 1, None), loader(40)) is a and loads == [40] and reg.refcount((db, 1, None)) == 2
+        b = reg.acquire((db, 1, 7), loader(30), dependencies=[(db, 1, None)])     # hands the second reference over to (db,1,7)
+        assert reg.refcount((db, 1, None)) == 2
+        reg.release((db, 1, None))
+        reg.release((db, 1, 7))
+        assert reg.refcount((db, 1, None)) == 1                   # still held by the coefficients (db,1,7)
+        c = reg.acquire((db, 2, None), loader(50))                # 120 bytes > budget: evict (db,1,7), which frees (db,1,None)
+        assert reg.lookup((db, 1, 7)) is None and reg.lookup((db, 1, None)) is a
+        reg.release((db, 2, None))
+        d = reg.acquire((db, 3, None), loader(50))                # evicts the least recently used (db,1,None) but not (db,2,None)
+        assert reg.lookup((db, 1, None)) is None and reg.lookup((db, 2, None)) is c and reg.nbytes() == 100
+        assert reg.acquire((db, 3, None), loader(50)) is d
+        assert reg.refcount((db, 3, None)) == 2 and loads == [40, 30, 50, 50]
+        reg.discard('T.db')
+        assert reg.keys() == [(db, 3, None)]
+        e = reg.acquire((db, 4, None), loader(60))                # 110 bytes, all referenced: nothing to evict
+        assert reg.lookup((db, 4, None)) is e and reg.nbytes() == 110
+        reg.release((db, 4, None))                                # still over budget with (db,3,None) alone referenced
+        assert reg.keys() == [(db, 3, None)] and reg.nbytes() == 50
+        try:
+            reg.release((db, 2, None))
+            assert False
+        except KeyError:
+            pass
+        if verbose: print >>sys.stderr, reg.report()
+
+        ConciseMonitor.enable(False)
+        app = Application(None,"TestRegistry",verbose,True)
+        dbfile = app.dbFilePath + ".prefetch"                     # a writable copy without the derived tables
+        shutil.copyfile(app.dbFilePath, dbfile)
+        db = Database(dbfile)
+        for tablename in derived_matrix_tablenames.values():
+            db.execute("DROP TABLE IF EXISTS %s" % tablename)
+        seriessetid = TimeSeriesSet.seriessetids(db)[0]
+        prefetcher = Prefetcher(db, [ (seriessetid, 0) ])
+        prefetcher.start()
+        prefetcher.join()
+        tss = acquire_timeseriesset(db, seriessetid)
+        coeffid = tss.coeffids()[0]
+        assert prefetcher.prefetched == [ (seriessetid, None), (seriessetid, coeffid) ]
+        cm = acquire_coefficients(db, tss, coeffid)
+        assert cm.db() is db and not cm.isderivedinmemory()      # derived as when loaded in the foreground, although prefetched on a read-only connection
+        cm.getmatrix('best')
+        assert Coefficients.derived_tables_stored(db)
+        release(db, seriessetid, coeffid)
+        release(db, seriessetid)
+        the_registry.discard(dbfile)
+        db.close()
+        os.remove(dbfile)
+
+        print "Registry okay"
+
+
+def registry_path(dbpath):
+    return os.path.realpath(dbpath)
+
+
+the_registry = Registry()
+
+
+def acquire_timeseriesset(db, seriessetid, loaddb=None, payload=None):     # loaddb: the connection to load on, if not db's; payload: see TimeSeriesSet.payload()
+    def load():
+        tss = TimeSeriesSet(loaddb or db, seriessetid, payload)
+        tss.setdb(db)
+        return tss
+    return the_registry.acquire((registry_path(db.filepath()), seriessetid, None), load)
+
+def acquire_coefficients(db, tss, coeffid, loaddb=None, current=True):  # the caller holds tss, acquired with acquire_timeseriesset()
+    def load():
+        cm = tss.coefficients()                                     # the TimeSeriesSet loads its most recent Coefficients itself
+        if cm is None or cm.coeffid() != coeffid or cm.db() is not (loaddb or db):
+            cm = tss.loadcoefficients(loaddb or db, coeffid, current=False)
+        if loaddb:
+            cm.prefetch(['value'])                                  # the imported matrix only: the others load on first use, on db once handed over
+            cm.setdb(db)
+        return cm
+    dbpath = registry_path(db.filepath())
+    tsskey = (dbpath, tss.seriessetid(), None)
+    the_registry.acquire(tsskey, lambda: tss)                       # the reference on tss held by the Coefficients entry
+    cm = the_registry.acquire((dbpath, tss.seriessetid(), coeffid), load, dependencies=[tsskey])
+    if current:
+        tss.setcoefficients(cm)
+    return cm
+
+def release(db, seriessetid, coeffid=None):
+    the_registry.release((registry_path(db.filepath()), seriessetid, coeffid))
+
+
+the_preload_pool = None                                             # the worker processes of preload(), see start_preload_pool()
+
+
+def start_preload_pool(processes=None):                             # start preload()'s worker processes, by default one per CPU
+    # Call this before Qt starts and before any database is opened: on Linux and the Mac the workers are forked, and a fork of a process
+    # that is running Qt (Cocoa on the Mac) or holds an sqlite connection is not safe. On Windows they are spawned instead and re-import
+    # the main module, whose start-up must therefore be guarded by if __name__ == '__main__'
+    global the_preload_pool
+    if the_preload_pool is None:
+        the_preload_pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+    return the_preload_pool
+
+def preload(db, seriessetids):                                      # the number of TimeSeriesSets loaded, in the processes of start_preload_pool()
+    global the_preload_pool
+    usage = ConciseMonitor()
+    dbpath = registry_path(db.filepath())
+    todo = [ seriessetid for seriessetid in seriessetids if the_registry.lookup((dbpath, seriessetid, None)) is None ]
+    loaded = 0
+    if not todo:
+        return loaded
+    if the_preload_pool is None:
+        Application.the_app.log('preload: no worker processes, see start_preload_pool()')
+        return loaded
+    try:
+        for seriessetid, payload in the_preload_pool.imap_unordered(_load_payload, [ (db.filepath(), seriessetid) for seriessetid in todo ]):
+            tss = acquire_timeseriesset(db, seriessetid, payload=payload)
+            try:
+                if tss.coefficients() is not None:
+                    coeffid = tss.coefficients().coeffid()
+                    acquire_coefficients(db, tss, coeffid, current=False)
+                    release(db, seriessetid, coeffid)
+            finally:
+                release(db, seriessetid)
+            loaded += 1
+    except:
+        Application.the_app.log('preload: %s' % sys.exc_info()[1])     # preloading is an optimisation only, the rest are loaded on demand
+        the_preload_pool.terminate()                                # the workers may still be loading the rest: no more preloading
+        the_preload_pool.join()
+        the_preload_pool = None
+    usage.report('preload %s %s of %s TimeSeriesSets' % (db.basename(), loaded, len(todo)))
+    return loaded
+
+def _load_payload(request):                                         # runs in a preload() process
+    filepath, seriessetid = request
+    if Application.the_app is None:                                 # a spawned rather than a forked process
+        Application(None, 'BC preload')
+    db = Database(filepath, readonly=True)
+    try:
+        return seriessetid, TimeSeriesSet.payload(db, seriessetid)
+    finally:
+        db.close()
+
+
+class Prefetcher(threading.Thread):
+    """ Prefetcher loads TimeSeriesSets and Coefficients into the_registry in the background, on its own connection to the database """
+
+    SHARE = 0.75                                            # prefetch while the registry holds less than this share of its budget
+
+    def __init__(self, db, plan):
+        threading.Thread.__init__(self, name='Prefetcher %s' % db.basename())
+        self.daemon = True
+        self._db = db                                       # the Database that prefetched objects are handed over to
+        self._plan = list(plan)                             # [ (seriessetid, scenario) ], scenario indexes tss.coeffids(), None for the TimeSeriesSet alone
+        self._cancelled = threading.Event()
+        self._discard = False
+        self.prefetched = [ ]                               # keys loaded or found in the registry, in plan order
+
+    def cancel(self, discard=False):                        # stop after the object being loaded; the thread is not waited for
+        self._discard = discard                             # discard: the database is being closed, forget what was prefetched
+        self._cancelled.set()
+
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def run(self):
+        usage = ConciseMonitor()
+        try:
+            with self._db.reader() as loaddb:
+                for seriessetid, scenario in self._plan:
+                    if self.cancelled() or the_registry.nbytes() >= self.SHARE * the_registry.budget:
+                        break
+                    tss = acquire_timeseriesset(self._db, seriessetid, loaddb)
+                    try:
+                        self.prefetched.append((seriessetid, None))
+                        if scenario is not None and scenario < len(tss.coeffids()) and not self.cancelled():
+                            coeffid = tss.coeffids()[scenario]
+                            acquire_coefficients(self._db, tss, coeffid, loaddb, current=False)
+                            release(self._db, seriessetid, coeffid)
+                            self.prefetched.append((seriessetid, coeffid))
+                    finally:
+                        release(self._db, seriessetid)
+            if self.cancelled() and self._discard:
+                the_registry.discard(self._db.filepath())
+        except:
+            Application.the_app.log('Prefetcher: %s' % sys.exc_info()[1])   # prefetching is an optimisation only
+        usage.report('Prefetcher %s %s objects prefetched for a plan of %s%s' % (self._db.basename(), len(self.prefetched), len(self._plan), ', cancelled' if self.cancelled() else ''))
+
+
+if __name__ == '__main__':
+    Registry.tunit(len(sys.argv) > 1)
@@ -17,6 +17,7 @@ from application import *
 from config import *
 from database import *
 from dict import *
+from registry import *
 from sparse import *
 from timepoint import *
 from timeseries import *
@@ -40,7 +41,9 @@ class Run_all_tests:                    # "static" class since it only contains
         Config.tunit(verbose)
         Database.tunit(verbose)
         Dict.tunit(verbose)
+        Registry.tunit(verbose)
         SparseMatrix.tunit(verbose)
+        CsrMatrix.tunit(verbose)
         TimePoint.tunit(verbose)
         TimeSeriesSet.tunit(verbose)
         Version.tunit(verbose)
@@ -98,7 +98,7 @@ class Showxy:
             print colfmt % tdisp,
         print
         def getthings(listlike,n):
-            return [ listlike[i] for i in range(n) ]
+            return nullable(listlike,n)
         for ts in tss.series():
             if not tss.isevents(): leader = leadfmt % (ts.label(), len(ts), '%.2f'%ts.min(), '%.2f'%ts.max())
             if tss.isevents(): leader = eventleadfmt % ts.label()
@@ -9,8 +9,22 @@
 #       A value is only stored in the matrix if it is non-zero.
 #
 ####################################################################################
+#
+#       CsrMatrix(N): a read-only NxN sparse matrix in compressed sparse row form.
+#
+#       The non-zero values are held in three numpy arrays: indptr, indices, data.
+#       The columns of row i are indices[indptr[i]:indptr[i+1]], in ascending order,
+#       and their values are the same slice of data.
+#
+#       cm[i] returns a SparseRow, a read-only view of row i that behaves like the
+#       row dicts of SparseMatrix: j in row, row[j], iteration over the columns,
+#       len(row), keys(), values(), items(). Client code written for SparseMatrix
+#       therefore works unchanged on a CsrMatrix.
+#
+####################################################################################
 
 import sys
+import numpy
 
 
 class SparseMatrix(list):
@@ -47,6 +61,139 @@ class SparseMatrix(list):
         print "SparseMatrix okey dokey"
 
 
+class SparseRow(object):
+    """ SparseRow is a read-only dict-like view { column => value } of the non-zero values in one row of a CsrMatrix """
+
+    __slots__ = ('_columns', '_values', '_dict', '_probes')
+
+    PROBES_BEFORE_DICT = 8              # single lookups bisect the row; a view that is probed repeatedly builds a dict instead
+
+    def __init__(self,columns,values):
+        self._columns = columns         # views into the indices and data arrays of the CsrMatrix
+        self._values = values
+        self._dict = None
+        self._probes = 0
+
+    def _lookup(self):
+        if self._dict is None:
+            self._dict = dict(zip(self._columns.tolist(),self._values.tolist()))
+        return self._dict
+
+    def _find(self,j):                  # the position of column j in the row, or -1
+        k = self._columns.searchsorted(j)
+        return k if k < len(self._columns) and self._columns[k] == j else -1
+
+    def __contains__(self,j):
+        if self._dict is None:
+            self._probes += 1
+            if self._probes < self.PROBES_BEFORE_DICT:
+                return self._find(j) >= 0
+        return j in self._lookup()
+
+    def __getitem__(self,j):
+        if self._dict is None:
+            self._probes += 1
+            if self._probes < self.PROBES_BEFORE_DICT:
+                k = self._find(j)
+                if k < 0: raise KeyError, j
+                return float(self._values[k])
+        return self._lookup()[j]
+
+    def __len__(self):                  return len(self._columns)
+    def __iter__(self):                 return iter(self._columns.tolist())
+    def __setitem__(self,j,value):      raise Exception, "SparseRow is read-only"
+    def __repr__(self):                 return repr(self._lookup())
+    def get(self,j,default=None):       return self[j] if j in self else default
+    def has_key(self,j):                return j in self
+    def keys(self):                     return self._columns.tolist()
+    def values(self):                   return self._values.tolist()
+    def items(self):                    return zip(self._columns.tolist(),self._values.tolist())
+    def iterkeys(self):                 return iter(self.keys())
+    def itervalues(self):               return iter(self.values())
+    def iteritems(self):                return iter(self.items())
+
+
+class CsrMatrix(object):
+    def __init__(self,N):
+        self.N = N
+        self.indptr = numpy.zeros(N+1,dtype=numpy.int64)
+        self.indices = numpy.zeros(0,dtype=numpy.int32)
+        self.data = numpy.zeros(0,dtype=numpy.float64)
+
+    def load_triplets(self,rows,cols,values):      # (re)fill the matrix from the non-zero cells (rows[k], cols[k]) = values[k]
+        rows = numpy.asarray(rows,dtype=numpy.int64)
+        cols = numpy.asarray(cols,dtype=numpy.int32)
+        values = numpy.asarray(values,dtype=numpy.float64)
+        if len(rows) and (rows.min() < 0 or rows.max() >= self.N or cols.min() < 0 or cols.max() >= self.N):
+            raise Exception, "CsrMatrix cell out of range for N=%s" % self.N
+        order = numpy.lexsort((cols,rows))                 # row major, columns ascending within each row
+        self.indices = cols[order]
+        self.data = values[order]
+        self.indptr = numpy.zeros(self.N+1,dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(rows,minlength=self.N),out=self.indptr[1:])
+
+    def __len__(self):
+        return self.N
+    def __getitem__(self,i):
+        if i < 0: i += self.N
+        if not 0 <= i < self.N: raise IndexError, "CsrMatrix row %s out of range for N=%s" % (i,self.N)
+        lo, hi = self.indptr[i], self.indptr[i+1]
+        return SparseRow(self.indices[lo:hi],self.data[lo:hi])
+    def __iter__(self):
+        for i in xrange(self.N):
+            yield self[i]
+    def nnz(self):                      # the number of non-zero cells
+        return len(self.data)
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes + self.data.nbytes
+    def issparse(self):                 # yup. always sparse.
+        return True
+    def issymmetrical(self):            # symmetry is not assumed, nor is it known for this CsrMatrix
+        return False
+    def get(self,i,j):
+        lo, hi = self.indptr[i], self.indptr[i+1]
+        k = lo + numpy.searchsorted(self.indices[lo:hi],j)
+        return float(self.data[k]) if k < hi and self.indices[k] == j else 0
+
+    @staticmethod
+    def tunit(verbose):
+        n = 100
+        rows, cols, values = [], [], []
+        mat = SparseMatrix(n)
+        u = 1
+        for i in range(n):                                  # the same checkerboard as SparseMatrix.tunit, loaded in reverse order
+            for j in range(n):
+                if (i+j) % 2 == 0:
+                    mat[i][j] = u
+                    u += 1
+        for i in reversed(range(n)):
+            for j in mat[i]:
+                rows.append(i)
+                cols.append(j)
+                values.append(mat[i][j])
+        csr = CsrMatrix(n)
+        csr.load_triplets(rows,cols,values)
+        assert len(csr) == n and csr.nnz() == n*n/2
+        for i, row in enumerate(csr):
+            assert len(row) == len(mat[i]) and list(row) == sorted(mat[i])
+            assert dict(row.items()) == mat[i]
+            for j in range(n):
+                assert (j in row) == (j in mat[i])
+                assert csr.get(i,j) == mat.get(i,j)
+                if j in row:
+                    assert row[j] == mat[i][j]
+        try:
+            csr[0][0] = 1
+            assert False
+        except Exception, e:
+            assert 'read-only' in str(e)
+        empty = CsrMatrix(n)
+        assert empty.nnz() == 0 and len(empty[n-1]) == 0 and 0 not in empty[0]
+
+        print "CsrMatrix okey dokey"
+
+
 if __name__ == '__main__':
     SparseMatrix.tunit(len(sys.argv) > 1)
+    CsrMatrix.tunit(len(sys.argv) > 1)
 
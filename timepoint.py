@@ -24,10 +24,15 @@
 #    
 ####################################################################################
 
-import re, sys
+import datetime, re, sys
+import numpy
 from application import *
 
-class TimePoint:
+class TimePoint(object):
+
+    __slots__ = ('_interval', '_year', '_month', '_day', '_hashCode')     # _hashCode, the integer YYYYMMDD, orders and identifies TimePoints
+                                                                            # year, month and day are stored rather than derived from an ordinal, as the monthly and yearly
+                                                                            # next(), prev() and __str__() work on them directly; ordinal() is computed when a day count is needed
 
     yearlyPat  = re.compile(r'^(\d{1,4})$')
     monthlyPat = re.compile(r'^(\d{1,4})\D(\d{1,4})$')
@@ -36,26 +41,40 @@ class TimePoint:
     def __init__(self, interval, year, month, day):     # must construct one of the derived classes, DailyWeeklyTimePointMonthlyTimePointTimePoint YearlyTimePoint
                                                         # as this is an abstract base class
         if isinstance(interval, TimePoint):
-            other = interval
+            other = interval                            # already validated
             self._interval = other._interval
             self._year = other._year
             self._month = other._month
             self._day = other._day
+            self._hashCode = other._hashCode
         else:
             self._interval = interval
             self._year = year
             self._month = month
             self._day = day
-        self.calcHashCode()
-        self.validate()
+            self.calcHashCode()
+            self.validate()
+
+    _parsed = dict()                                    # { (interval,str) => TimePoint } memo of fromString(), whose results are clones
+    parsedMax = 100000                                  # the memo is emptied when it grows beyond this many strings
 
     @staticmethod
     def fromString(interval,str):                       # TimePoint factory creates a correctly typed TimePoint (derived class) based on str
                                                         # interval is force to match correct type if provided or an exception is raised
+        parsed = TimePoint._parsed.get((interval,str))
+        if parsed is None:
+            parsed = TimePoint._parse(interval,str)
+            if len(TimePoint._parsed) >= TimePoint.parsedMax:
+                TimePoint._parsed.clear()
+            TimePoint._parsed[(interval,str)] = parsed
+        return parsed.clone()
+
+    @staticmethod
+    def _parse(interval,str):
         mat = TimePoint.yearlyPat.match(str)
         if mat:
             if interval and interval != 'yearly': raise Exception, "TimePoint %s is yearly, not %s as requested" % (str,interval)
-            return YearlyTimePoint(mat.group(1))
+            return YearlyTimePoint(int(mat.group(1)))
         mat = TimePoint.monthlyPat.match(str)
         if mat:
             if interval and interval != 'monthly': raise Exception, "TimePoint %s is monthly, not %s as requested" % (str,interval)
@@ -81,31 +100,40 @@ class TimePoint:
     def month(self):         return self._month
     def day(self):           return self._day
     
+    def __getstate__(self):  return (self._interval, self._year, self._month, self._day, self._hashCode)
+    def __setstate__(self,state):
+        self._interval, self._year, self._month, self._day, self._hashCode = state
+
     def __hash__(self):      return self._hashCode
     def __cmp__(self,other): return self._hashCode - other._hashCode
 
-    def __sub__(self,other):
-        d = 0
-        iter = (self < other and self or other).clone()
-        end = self < other and other or self
-        incr = self < other and -1 or +1
-        while iter < end:
-            d += incr
-            iter.next()
-        return d
+    def __sub__(self,other):            # the number of steps of the earlier TimePoint's interval that reach the later one, negative if self is the earlier
+        if self < other: return -self.stepsTo(other)
+        return other.stepsTo(self)
 
     def __add__(self,ninterval):
         res = self.clone()
-        if ninterval >= 0:
-            while ninterval > 0:
-                res.next()
-                ninterval -= 1
-        else:
-            while ninterval < 0:
-                res.prev()
-                ninterval += 1
+        res.advance(ninterval)
         return res
 
+    def stepsTo(self,later): raise Exception, "TimePoint.stepsTo() is abstract"    # the number of next() calls from self that reach at least later, in closed form
+    def advance(self,n):     raise Exception, "TimePoint.advance() is abstract"    # n next() calls, or -n prev() calls, in closed form
+
+    def ordinal(self):                  # the proleptic Gregorian ordinal of the day, as in datetime.date
+        return datetime.date(self._year,self._month,self._day).toordinal()
+
+    def setOrdinal(self,ordinal):
+        date = datetime.date.fromordinal(ordinal)
+        self._year, self._month, self._day = date.year, date.month, date.day
+        self.calcHashCode()
+
+    def months(self):                   # months since the start of year 0
+        return self._year * 12 + self._month - 1
+
+    def setMonths(self,months):
+        self._year, self._month = months // 12, months % 12 + 1
+        self.calcHashCode()
+
     def transmogrify(self,interval):     # TimePoint cloned from self, but whose type is based on the provided interval
         if interval == 'daily':     return DailyTimePoint(self._year,self._month,self._day)
         if interval == 'weekly':    return WeeklyTimePoint(self._year,self._month,self._day)
@@ -113,13 +141,11 @@ class TimePoint:
         if interval == 'yearly':    return YearlyTimePoint(self._year)
         raise Exception, "cannot transmogrify(%s,%s)" % (self,interval)
 
-    def timeVector(self,ntimes):
-        times = [ ]
-        timePoint = self.clone()
-        for i in range(ntimes):
-            times.append(str(timePoint))
-            timePoint.next()
-        return times
+    timeVectorStep = 1                  # the interval in the numpy datetime64 units of str(self)
+
+    def timeVector(self,ntimes):        # [ str(self), str(self+1), ... ] of ntimes labels
+        start = numpy.datetime64(str(self))
+        return numpy.arange(start,start + ntimes * self.timeVectorStep,self.timeVectorStep).astype(str).tolist()
 
     @staticmethod
     def intervalOf(times):
@@ -192,7 +218,7 @@ class TimePoint:
     def prevdays(self, ndays):
         if ndays < 0 or ndays > 7: raise Exception, "prevdays(%s) is invalid: must be in range[0,7]" % ndays
         self._day -= ndays
-        if self._day < 0:
+        if self._day < 1:
             self._month -= 1
             if self._month < 1:
                 self._month = 12
@@ -435,12 +461,23 @@ class TimePoint:
         assert p1-DailyTimePoint(2000,1,27) ==  +31
         assert p1-DailyTimePoint(1999,2,27) == +365
 
+        assert DailyTimePoint(2000,3,1)+-1 == DailyTimePoint(2000,2,29)
+        p5 = DailyTimePoint(2000,3,1)
+        p5.prev()
+        assert p5 == DailyTimePoint(2000,2,29)
+        assert WeeklyTimePoint(2000,3,7)+-1 == WeeklyTimePoint(2000,2,29)
+        assert DailyTimePoint(2013,1,1)-DailyTimePoint(2000,1,1) == 4749
+        assert MonthlyTimePoint(2000,1)-DailyTimePoint(1999,12,15) == 17     # steps of the earlier TimePoint's interval
+        assert DailyTimePoint(2000,1,1).timeVector(0) == [ ]
+
         print "DailyTimePoint okay"
 
         print "TimePoint okay"
 
 class YearlyTimePoint(TimePoint):
 
+    __slots__ = ()
+
     def __init__(self,str):
         if isinstance(str,TimePoint):
             TimePoint.__init__(self,str,None,None,None)
@@ -452,8 +489,15 @@ class YearlyTimePoint(TimePoint):
     def next(self):     return self.nextyear()
     def prev(self):     return self.prevyear()
 
+    def stepsTo(self,later):    return later._year - self._year + ((self._month,self._day) < (later._month,later._day) and 1 or 0)
+    def advance(self,n):
+        self._year += n
+        self.calcHashCode()
+
 class MonthlyTimePoint(TimePoint):
 
+    __slots__ = ()
+
     def __init__(self,*args):
         if isinstance(args[0],TimePoint):
             TimePoint.__init__(self,args[0],None,None,None)
@@ -467,8 +511,13 @@ class MonthlyTimePoint(TimePoint):
     def next(self):     return self.nextmonth()
     def prev(self):     return self.prevmonth()
 
+    def stepsTo(self,later):    return later.months() - self.months() + (self._day < later._day and 1 or 0)
+    def advance(self,n):        self.setMonths(self.months() + n)
+
 class DailyTimePoint(TimePoint):
 
+    __slots__ = ()
+
     def __init__(self,*args):
         if isinstance(args[0],TimePoint):
             TimePoint.__init__(self,args[0],None,None,None)
@@ -482,8 +531,13 @@ class DailyTimePoint(TimePoint):
     def next(self):     return self.nextdays(1)
     def prev(self):     return self.prevdays(1)
 
+    def stepsTo(self,later):    return later.ordinal() - self.ordinal()
+    def advance(self,n):        self.setOrdinal(self.ordinal() + n)
+
 class WeeklyTimePoint(TimePoint):
 
+    __slots__ = ()
+
     def __init__(self,*args):
         if isinstance(args[0],TimePoint):
             TimePoint.__init__(self,args[0],None,None,None)
@@ -497,6 +551,11 @@ class WeeklyTimePoint(TimePoint):
     def next(self):     return self.nextdays(7)
     def prev(self):     return self.prevdays(7)
 
+    timeVectorStep = 7
+
+    def stepsTo(self,later):    return (later.ordinal() - self.ordinal() + 6) // 7
+    def advance(self,n):        self.setOrdinal(self.ordinal() + 7 * n)
+
 if __name__ == '__main__':
     TimePoint.tunit(len(sys.argv) > 1)
 
@@ -18,7 +18,8 @@
 #
 ####################################################################################
 
-import math, sys
+import itertools, math, os, shutil, sys
+import numpy
 from application import *
 from coefficient import *
 from database import *
@@ -40,13 +41,22 @@ class as_list(object):
     def __getitem__ (self,i):
         return self.call(i)
 
+def isnull(value):                      # a missing datapoint: None from an EventSeries or as_list, NaN from the TimeSeries value arrays
+    return value is None or value != value
+
+def nullable(values,length):            # the first length datapoints of a getAllXxxxx() array as a list, with None for missing datapoints and beyond the end
+    if not isinstance(values,numpy.ndarray):
+        return [ values[i] for i in range(length) ]
+    res = [ None if value != value else value for value in values[:length].tolist() ]
+    return res + [ None ] * (length - len(res))
+
 class TimeSeries(object):
 
     ## VF_INTERPOLATED = 0x0001                # value flags     ## V4.016 - remove valueflags and HandyAndySeries
     ## VF_ESTIMATED    = 0x0002
 
-    def __init__(self,db,tss,seriesid,ordinal):
-
+    def __init__(self,db,tss,seriesid,ordinal,seriesdict=None,values=None):
+                                        # seriesdict and values are supplied by the TimeSeriesSet bulk loader, otherwise they are queried here
         self.app = Application.the_app
         self._values = None
         self._normvalues = None
@@ -54,98 +64,43 @@ class TimeSeries(object):
         self._seriesid = seriesid
         self._ordinal = ordinal
         self._categoryparts = None
-        self._dict = Dict(db,"TimeSeries",seriesid)
-        self._start = tss.start() + self.startoff()
+        self._dict = seriesdict if seriesdict is not None else Dict(db,"TimeSeries",seriesid)
+        self._start = tss.timepoint(self.startoff())
         self._tss = tss
 
         self._categoryparts = self.category().split(':')
 
-        self._load_values()
+        self._minvalue = None           # min(), max(), the normalised values and the intensities are calculated for all the series at once
+        self._maxvalue = None           # by TimeSeriesSet._normalise_values() once the values of all the series have been loaded
 
-        # the getAllXxxxx(i) family of methods now access the required parts of the time series dynamically, taking startoff() and endoff() into account
+        self._load_values(values)
 
-        self._getAllValues =  as_list(self,'getvalue')
-        self._getAllNormValues =  as_list(self,'getnormvalue')
-        self._getAllIntensities =  as_list(self,'getintensity')
     def uniqueId(self):
        return self._dict["uniqueid"] if "uniqueid" in self._dict else ""
     def forecasting(self):
        return self._dict["forecasting"] if "forecasting" in self._dict else ""
-    def _load_values(self):
+    def _load_values(self,values=None):
 
         # load values: we discard NULL values since databases prior to the v4.023 Importer stored NULL value padding before startoff() and after endoff(), a waste of space
-        self._values = [ float(v) for v in self._tss.db().selectColumn("SELECT value FROM seriesvalue WHERE seriesid=? AND value IS NOT NULL ORDER BY timeid",self._seriesid) ]
-
-        LUMPIES = self.islumpy()
-
-        self._minvalue = +1e50
-        self._maxvalue = -1e50
-        for val in self._values:
-            if val != None:
-                if (not LUMPIES) or (LUMPIES and val != 0):
-                    self._minvalue = min(self._minvalue,val)
-                    self._maxvalue = max(self._maxvalue,val)
-
-        self._intensities = [ 1.0, ] * len(self)
-
-        if LUMPIES:
-            # the intensity of a displayed bubble varies during a sequence of zeros in the series
-            # varies according to one complete cycle of the cosine function
-            A = 0.75            # amplitude of the cosine, i.e. luminosity varies from 1.0 down to 1-A
-            startzero = -1
-            i = 0
-            self._intensities = [ ]
-            for val in self._values:
-                if val == None:
-                    self._intensities.append(None)
-                elif val == 0:
-                    if startzero < 0: startzero = i
-                else:
-                    if startzero >= 0:
-                        N = i - startzero                # the number of zero values
-                        # print >>sys.stderr,"Intensity time for [%s,%s]" % (startzero,i)
-                        for j in range(N+2):
-                            if j > 0 and j < N+1:        # intensities range from +1 through 1-A back up to +1; discard the +1 and -1
-                                self._intensities.append( A/2 * math.cos(2*j*math.pi/(N+1)) + (1-A/2)  )
-                                # print >>sys.stderr,"Appending intensity %s for %s/%s in ts %s" % (self._intensities[len(self._intensities)-1],j,N,self.label())
-                        startzero = -1
-                    self._intensities.append(1.0)
-                i += 1
-            if startzero >= 0:
-                N = i - startzero                # the number of zero values
-                # print >>sys.stderr,"Intensity time for [%s,%s]" % (startzero,i)
-                for j in range(N+2):
-                    if j > 0 and j < N+1:        # intensities range from +1 through 1-A back up to +1; discard the +1 and -1
-                        self._intensities.append( A/2 * math.cos(2*j*math.pi/(N+1)) + (1-A/2)  )
-                        # print >>sys.stderr,"Appending intensity %s for %s/%s in ts %s" % (self._intensities[len(self._intensities)-1],j,N,self.label())
-
-            # zeros are set to their last non-zero (holding) value
-            origvalues = self._values
-            self._values = [ ]
-            holding = 0
-            for val in origvalues:
-                if val == 0: val = holding
-                self._values.append(val)
-                holding = val
-            holding = 0
-            N = len(self._values)
-            for i in range(N):      # catch any leading zeros and set to next holding value (by traversing in reverse)
-                val = self._values[N-1-i]
-                if val == 0: self._values[N-1-i] = holding
-                else: holding = val
-
-        maxmin = self._maxvalue - self._minvalue
-        self._normvalues = []
-        for val in self._values:
-            assert val != None      # V4.016 - we only store the contiguous non-null "active" time series datapoints, sans null pre-padding and post-padding
-            if maxmin == 0:
-                if val == 0:
-                    self._normvalues.append (0)
-                else:
-                    self._normvalues.append (1)
-            else:
-                self._normvalues.append((val-self._minvalue) / maxmin)
-
+        if values is None:
+            values = self._tss.db().selectColumn("SELECT value FROM seriesvalue WHERE seriesid=? AND value IS NOT NULL ORDER BY timeid",self._seriesid)
+
+        # the values go into this series' row of the TimeSeriesSet's arrays: _values, _normvalues and _intensities are views of the active part of the rows,
+        # and the getAllXxxxx() family of methods return read-only views of the whole rows, indexed by time and NaN outside startoff() and endoff()
+
+        start = self.startoff()
+        end = start + len(values)
+        if end > self._tss.ntimes(): raise Exception, "TimeSeries %s has %s values from startoff %s, beyond the %s times of its TimeSeriesSet" % (self.label(),len(values),start,self._tss.ntimes())
+        self._tss.valuearray()[self._ordinal,start:end] = values
+        rows = [ ]
+        for array in (self._tss.valuearray(), self._tss.normvaluearray(), self._tss.intensityarray()):
+            view = array[self._ordinal].view()
+            view.flags.writeable = False
+            rows.append(view)
+        self._values, self._normvalues, self._intensities = [ view[start:end] for view in rows ]
+        self._getAllValues, self._getAllNormValues, self._getAllIntensities = rows
+
+    def _log_values(self):
         self.log("TimeSeries: %s-%s %s %s %s[%s] LRD=%s minv=%s maxv=%s" % (
               self.startoff()
             , self.endoff()
@@ -166,7 +121,7 @@ class TimeSeries(object):
 
     def __str__(self):
         res = "[%s-%s-%s#%s$%s%%%s]" % (self.label(),self.category(),self.tooltip(),self.ordinal(),self.seriesid(),self.lastdeltapc())
-        tpoint = self.start().clone()
+        tpoint = self.start()
         for i in range(len(self)):
             if i >= self.maxStringisedDatapoints-1: break
             res +=  " %s,%s" % (self._values[i], tpoint)
@@ -233,8 +188,8 @@ class TimeSeries(object):
     def tooltip(self):
         return self._dict["tooltip"]
 
-    def start(self):            # returns the starting TimePoint for the time series
-        return self._start
+    def start(self):            # returns a copy of the starting TimePoint for the time series, as self._start is shared with the TimeSeriesSet's timepoints()
+        return self._start.clone()
 
     def ordinal(self):
         return self._ordinal
@@ -251,6 +206,8 @@ class TimeSeries(object):
 
     ## V4.016 - TimeSeries does not store flags, times, all values and normalised values and intensities (rather just non null values), nor any original values, binary values
 
+    ## the getAllXxxxx() arrays are indexed by time, i.e. [0,ntimes), with NaN where the series has no datapoint: test datapoints with isnull(), or use nullable()
+
     def getAllValues(self):
         return self._getAllValues
 
@@ -300,6 +257,8 @@ class TimeSeries(object):
 
 class TimeSeriesSet(object):
 
+    bulkload = True                         # load all the TimeSeries' dicts and values in two queries, rather than two queries per TimeSeries
+
     def clone(self):                        # return a copy of this TimeSeriesSet, *** coefficient matrices and the time series are NOT deep copied ***
 
         copy = TimeSeriesSet()
@@ -309,6 +268,7 @@ class TimeSeriesSet(object):
         copy._series = list(self._series)
         copy._shared_times = list(self._shared_times)
         copy._start = self._start.clone()
+        copy._timepoints = None
         copy._interesting_categoryparts_ordinal = list(self._interesting_categoryparts_ordinal)
         copy._interesting_categoryparts_level = self._interesting_categoryparts_level
         copy._events = self._events
@@ -320,14 +280,19 @@ class TimeSeriesSet(object):
         copy._coeffnames = self._coeffnames
         copy._coefficients = self._coefficients
         copy._usesparse = self._usesparse
+        copy._valuearray = self._valuearray
+        copy._normvaluearray = self._normvaluearray
+        copy._intensityarray = self._intensityarray
 
         return copy
 
-    def __init__(self, db=None, seriessetid=None):
+    def __init__(self, db=None, seriessetid=None, payload=None):
+                                            # payload: the rows and arrays of seriessetid from TimeSeriesSet.payload(), e.g. loaded in another process, rather than queried here
 
         resource_usage = ConciseMonitor()
         resource_timeseries = 0
         resource_coefficients = 0
+        resource_queries = 0
 
         if db and not seriessetid: raise Exception("cannot create a TimeSeriesSet from the database (db=%s) without a seriessetid" % db.filepath())
 
@@ -336,6 +301,7 @@ class TimeSeriesSet(object):
         self._series = [ ]
         self._shared_times = None
         self._start = None
+        self._timepoints = None
         self._interesting_categoryparts_ordinal = [ ]        # each unique "first interesting" TimeSeries category part is assigned an ordinal starting at 0
         self._interesting_categoryparts_level = 0            # "first interesting" means the level into the category parts that changes form one TimeSeries to the next
         self._events = None
@@ -347,29 +313,52 @@ class TimeSeriesSet(object):
         self._coeffnames = dict()
         self._coefficients = None
         self._usesparse = True
+        self._valuearray = None                             # float64 arrays of one row per TimeSeries and one column per time, NaN for missing datapoints
+        self._normvaluearray = None
+        self._intensityarray = None
 
         if db:
-            Dict.KNOWNCLASSES = None      # HACK HACK HACK - force Dict to reload its KNOWNCLASSES since they can vary from one database to another
             self._dict = Dict(db,"TimeSeriesSet",seriessetid)
             self._seriessetid = seriessetid
-            self._shared_times = db.selectColumn("SELECT time FROM time WHERE seriessetid=? ORDER BY timeid",seriessetid)
+            if payload is not None:
+                self._shared_times = payload['times']
+                seriesids = payload['seriesids']
+            else:
+                self._shared_times, seriesids = self._load_times_and_seriesids(db,seriessetid)
             self._start = TimePoint.fromString(TimePoint.intervalOf(self._shared_times), self._shared_times[0])
 
-            seriesids = db.selectColumn("SELECT seriesid FROM series WHERE seriessetid=?",self._seriessetid)
-            for ordinal in range(len(seriesids)):
-                self._series.append(TimeSeries(db,self,seriesids[ordinal],ordinal))
+            self._valuearray, self._normvaluearray, self._intensityarray = [ numpy.empty((len(seriesids),self.ntimes())) for i in range(3) ]
+            for array in (self._valuearray, self._normvaluearray, self._intensityarray):
+                array.fill(numpy.nan)
+            if payload is not None or self.bulkload:
+                if payload is not None:
+                    seriesdicts, seriesvalues = self._unpack_series(db,payload)
+                else:
+                    seriesdicts, seriesvalues = self._bulk_load_series(db,seriessetid,seriesids)
+                for ordinal in range(len(seriesids)):
+                    seriesid = seriesids[ordinal]
+                    self._series.append(TimeSeries(db,self,seriesid,ordinal,seriesdicts[seriesid],seriesvalues.get(seriesid,())))
+                resource_queries = 0 if payload is not None else 2
+            else:
+                for ordinal in range(len(seriesids)):
+                    self._series.append(TimeSeries(db,self,seriesids[ordinal],ordinal))
+                resource_queries = 2 * len(seriesids)
+            self._normalise_values()
             resource_timeseries = len(self)
             self._events = EventSeriesSet(self,db)  # load the events only after _shared_times has been initialised
             self.app.log("TimeSeriesSe %s [%s series]" % (self.details(), len(self)))
 
-            for row in db.selectRows("SELECT coeffid,value FROM coeff c, dict d WHERE c.seriessetid=? AND c.coeffid=d.clientid AND d.key='description' ORDER BY coeffid DESC",seriessetid):
+            for row in self._load_coeff_descriptions(db,seriessetid):
                 self._coeffids.append(int(row[0]))
                 self._coeffindex[int(row[0])] = row[1]
 
             for row in db.selectRows("SELECT value,coeffid FROM coeff c, dict d WHERE c.coeffid=d.clientid AND d.key='name'"):
                 self._coeffnames[row[0]] = row[1]
 
-            self.loadcoefficients(db,self._coeffids[0])
+            if payload is not None and payload['coeffid'] == self._coeffids[0]:
+                self.loadcoefficients(db,self._coeffids[0],value=payload['value'])
+            else:
+                self.loadcoefficients(db,self._coeffids[0])
             resource_coefficients = self._coefficients.cardinality()
 
         lpi = 0        # give each different interesting (first or deeper "level" or interesting_categoryparts_level) categorypart a unique ordinal
@@ -393,8 +382,129 @@ class TimeSeriesSet(object):
         self.log("interesting_categoryparts_ordinal = %s" % self._interesting_categoryparts_ordinal)
 
         tssid = '#%s' % self.seriessetid() if self.seriessetid() else ''
-        resource_usage.report('%s init %s %s ts %s coeffs' % (type(self).__name__, tssid, resource_timeseries, resource_coefficients))
+        resource_usage.report('%s init %s %s ts %s coeffs %s ts queries (%s)' % (type(self).__name__, tssid, resource_timeseries, resource_coefficients,
+            resource_queries, 'payload' if payload is not None else 'bulk' if self.bulkload else 'per series'))
+
+    @staticmethod
+    def _load_times_and_seriesids(db,seriessetid):      # the queries shared by TimeSeriesSet() and payload(): (times, seriesids)
+        times = db.selectColumn("SELECT time FROM time WHERE seriessetid=? ORDER BY timeid",seriessetid)
+        seriesids = db.selectColumn("SELECT seriesid FROM series WHERE seriessetid=?",seriessetid)
+        return times, seriesids
+
+    @staticmethod
+    def _load_series_rows(db,seriessetid):              # the queries shared by _bulk_load_series() and payload(): the (seriesid, key, value) dict rows
+                                                        # and an iterator over the (seriesid, value) datapoints, in timeid order within each seriesid
+        client = Dict.clientOf(db,"TimeSeries")
+        dictrows = db.selectRows("SELECT d.clientid,d.key,d.value FROM series s, dict d WHERE s.seriessetid=? AND d.client=? AND d.clientid=s.seriesid",seriessetid,client)
+        return dictrows, db.iterRows("SELECT v.seriesid,v.value FROM series s, seriesvalue v WHERE s.seriessetid=? AND v.seriesid=s.seriesid AND v.value IS NOT NULL ORDER BY v.seriesid,v.timeid",seriessetid)
+
+    @staticmethod
+    def _load_coeff_descriptions(db,seriessetid):       # the (coeffid, description) rows of seriessetid's Coefficients, most recent first
+        return db.selectRows("SELECT coeffid,value FROM coeff c, dict d WHERE c.seriessetid=? AND c.coeffid=d.clientid AND d.key='description' ORDER BY coeffid DESC",seriessetid)
 
+    @staticmethod
+    def _bulk_load_series(db,seriessetid,seriesids):     # return ({ seriesid: Dict }, { seriesid: [ value, ... ] }) for the seriesids, one query for each
+        dictrows, valuerows = TimeSeriesSet._load_series_rows(db,seriessetid)
+        seriesdicts = dict( (seriesid, Dict(db,"TimeSeries",seriesid,())) for seriesid in seriesids )
+        for (seriesid, key, value) in dictrows:
+            seriesdicts[seriesid][key] = value
+        seriesvalues = { }
+        for (seriesid, value) in valuerows:
+            if seriesid not in seriesvalues: seriesvalues[seriesid] = [ ]
+            seriesvalues[seriesid].append(value)
+        return seriesdicts, seriesvalues
+
+    @staticmethod
+    def payload(db,seriessetid):        # the rows and arrays that TimeSeriesSet(db,seriessetid,payload) is built from, compact enough to send between processes:
+                                        # dict(times, seriesids, dictrows, valueids, values, coeffid, value), value being the CSR arrays of the coeffid's value matrix
+        times, seriesids = TimeSeriesSet._load_times_and_seriesids(db,seriessetid)
+        dictrows, valuerows = TimeSeriesSet._load_series_rows(db,seriessetid)
+        cells = numpy.fromiter(itertools.chain.from_iterable(valuerows), dtype=numpy.float64).reshape(-1,2)
+        coeffrows = TimeSeriesSet._load_coeff_descriptions(db,seriessetid)
+        coeffid = int(coeffrows[0][0]) if coeffrows else None
+        s2o = dict( (seriesid, ordinal) for ordinal, seriesid in enumerate(seriesids) )
+        value = Coefficients.value_arrays(db,coeffid,s2o) if coeffid is not None else None
+        return dict(times=times, seriesids=seriesids, dictrows=dictrows, valueids=cells[:,0].astype(numpy.int64), values=cells[:,1], coeffid=coeffid, value=value)
+
+    @staticmethod
+    def _unpack_series(db,payload):     # return ({ seriesid: Dict }, { seriesid: values array }) from a payload(), as _bulk_load_series() does from the database
+        seriesdicts = dict( (seriesid, Dict(db,"TimeSeries",seriesid,())) for seriesid in payload['seriesids'] )
+        for (seriesid, key, value) in payload['dictrows']:
+            seriesdicts[seriesid][key] = value
+        valueids, values = payload['valueids'], payload['values']
+        firsts = numpy.flatnonzero(numpy.concatenate(([True], valueids[1:] != valueids[:-1]))) if len(valueids) else numpy.zeros(0, dtype=numpy.int64)
+        ends = numpy.append(firsts[1:], len(valueids))
+        seriesvalues = dict( (seriesid, values[first:end]) for seriesid, first, end in zip(valueids[firsts].tolist(), firsts.tolist(), ends.tolist()) )
+        return seriesdicts, seriesvalues
+
+
+    LUMPY_AMPLITUDE = 0.75              # amplitude of the cosine, i.e. luminosity varies from 1.0 down to 1-A during a sequence of zeros in a lumpy series
+    _lumpy_ramps = { }                  # cache of { N: intensities for a sequence of N zeros }
+
+    @classmethod
+    def _lumpy_ramp(cls,N):             # intensities range from +1 through 1-A back up to +1 over one complete cycle of the cosine; discard the +1 at each end
+        if N not in cls._lumpy_ramps:
+            A = cls.LUMPY_AMPLITUDE
+            cls._lumpy_ramps[N] = [ A/2 * math.cos(2*j*math.pi/(N+1)) + (1-A/2) for j in range(1,N+1) ]
+        return cls._lumpy_ramps[N]
+
+    def _normalise_values(self):
+
+        # calculate min(), max(), the normalised values and the intensities of all the series at once from the value array
+        #
+        # lumpy series: zeros are ignored by min() and max(), the intensity during a sequence of zeros follows _lumpy_ramp(), and the zeros are then
+        # set to their last non-zero (holding) value, or for leading zeros the next non-zero value
+
+        values, normvalues, intensities = self._valuearray, self._normvaluearray, self._intensityarray
+        if not len(self._series): return
+        ntimes = values.shape[1]
+        active = ~numpy.isnan(values)
+        lumpy = numpy.array([ ts.islumpy() for ts in self._series ])
+        zeros = active & (values == 0) & lumpy[:,numpy.newaxis]
+        counted = active & ~zeros
+
+        minvalues = numpy.where(counted, values, +1e50).min(axis=1)
+        maxvalues = numpy.where(counted, values, -1e50).max(axis=1)
+
+        intensities[active] = 1.0
+        padded = numpy.zeros((len(self._series),ntimes+1), dtype=bool)     # the extra False column keeps sequences of zeros from running into the next row
+        padded[:,:ntimes] = zeros
+        where = numpy.flatnonzero(padded)
+        if len(where):
+            firsts = numpy.ones(len(where), dtype=bool)
+            firsts[1:] = where[1:] != where[:-1] + 1
+            sequence = numpy.cumsum(firsts) - 1
+            lengths = numpy.bincount(sequence)
+            nzeros = lengths[sequence]
+            j = where - where[firsts][sequence]                             # 0-based position of each zero in its sequence
+            distinct = numpy.unique(lengths)
+            offsets = numpy.zeros(len(distinct), dtype=int)
+            offsets[1:] = numpy.cumsum(distinct)[:-1]
+            ramps = numpy.array([ intensity for N in distinct for intensity in self._lumpy_ramp(N) ])
+            rows, cols = numpy.divmod(where, ntimes+1)
+            intensities[rows,cols] = ramps[offsets[numpy.searchsorted(distinct,nzeros)] + j]
+
+            columns = numpy.arange(ntimes)
+            holding = active & ~zeros
+            previous = numpy.maximum.accumulate(numpy.where(holding, columns, -1), axis=1)
+            following = numpy.minimum.accumulate(numpy.where(holding, columns, ntimes)[:,::-1], axis=1)[:,::-1]
+            rows, cols = numpy.nonzero(zeros)
+            held = previous[rows,cols]
+            leading = held < 0
+            held[leading] = following[rows[leading],cols[leading]]
+            found = held < ntimes
+            values[rows[found],cols[found]] = values[rows[found],held[found]]
+
+        maxmins = maxvalues - minvalues
+        flat = maxmins == 0
+        with numpy.errstate(invalid='ignore'):
+            normvalues[:] = (values - minvalues[:,numpy.newaxis]) / numpy.where(flat, 1, maxmins)[:,numpy.newaxis]
+        normvalues[flat] = numpy.where(values[flat] == 0, 0.0, 1.0)
+        normvalues[~active] = numpy.nan
+
+        for ts, minvalue, maxvalue in zip(self._series, minvalues.tolist(), maxvalues.tolist()):
+            ts._minvalue, ts._maxvalue = minvalue, maxvalue
+            ts._log_values()
 
     def __len__(self):
         return len(self._series)
@@ -408,10 +518,23 @@ class TimeSeriesSet(object):
     def coeffnames(self):                 # return a dict of { name, coeffid } for all coefficient matrices found in the database for this tss
         return self._coeffnames
 
-    def loadcoefficients(self,db,coeffid):
-        self._coefficients = Coefficients(db, self, coeffid, self._usesparse)
+    def loadcoefficients(self,db,coeffid,current=True,value=None):     # current: make the loaded Coefficients the current ones of this TimeSeriesSet
+                                                                        # value: the CSR arrays of the value matrix when already loaded, see payload()
+        coefficients = Coefficients(db, self, coeffid, self._usesparse, value)
+        if current:
+            self._coefficients = coefficients
+        return coefficients
+
+    def coefficients(self):                     # the current Coefficients
         return self._coefficients
 
+    def setcoefficients(self,coefficients):     # make coefficients, previously loaded for this TimeSeriesSet, the current ones
+        assert coefficients.tss() is self
+        self._coefficients = coefficients
+
+    def nbytes(self):                           # memory held by the value arrays; the Coefficients account for themselves
+        return sum(a.nbytes for a in (self._valuearray, self._normvaluearray, self._intensityarray) if a is not None)
+
     def events(self):
         return self._events
 
@@ -422,14 +545,15 @@ class TimeSeriesSet(object):
         return self._series
 
     def getcmat(self,matrixname='value'):
-        return self._coefficients._matrices[matrixname]
+        return self._coefficients.getmatrix(matrixname)
 
     def getcoeff(self,i,j,matrixname='value'):
         if random.random() < 0.001:
             print >>sys.stderr,'*** PeriodicDeprecationAnnoyance: tss.getcoeff(%s,%s,%s) must be replaced with: 0 if %s not in row else row[%s]' % (i,j,matrixname,j,j)
         ## CAREFUL: we are assuming ALL the matrices in the Coefficients are sparse for the POC
         ## return 0 if self._sparse and j not in self._coeffs[i] else self._coeffs[i][j]
-        return 0 if j not in self._coefficients._matrices[matrixname][i] else self._coefficients._matrices[matrixname][i][j]
+        row = self._coefficients.getmatrix(matrixname)[i]
+        return 0 if j not in row else row[j]
 
     def details(self):
         return self._dict["details"]
@@ -494,12 +618,34 @@ class TimeSeriesSet(object):
     def times(self):
         return self._shared_times
 
-    def start(self):            # returns the starting TimePoint for the entire set of timeseries
-        return self._start
+    def timepoints(self):       # the TimePoints of times(), created once and shared by the TimeSeries: do not modify them
+        if self._timepoints is None or self._timepoints[0] is not self._start:
+            self._timepoints = [ self._start ] + [ self._start + i for i in range(1,len(self._shared_times)) ]
+        return self._timepoints
+
+    def timepoint(self,i):      # the TimePoint i intervals after start(), shared if it is one of timepoints()
+        if 0 <= i < len(self._shared_times):
+            return self.timepoints()[i]
+        return self._start + i
+
+    def valuearray(self):       # N x ntimes() array of the TimeSeries' values, row i is getseries(i).getAllValues()
+        return self._valuearray
+
+    def normvaluearray(self):   # N x ntimes() array of the TimeSeries' normalised values
+        return self._normvaluearray
+
+    def intensityarray(self):   # N x ntimes() array of the TimeSeries' intensities
+        return self._intensityarray
+
+    def start(self):            # returns a copy of the starting TimePoint for the entire set of timeseries, as self._start is timepoints()[0]
+        return self._start.clone()
 
     def db(self):
         return self._db
 
+    def setdb(self,db):                         # hand a TimeSeriesSet loaded on another connection, e.g. in another thread, over to db
+        self._db = db
+
     def orphan_index(self):     # return a list of tuples:
                                 # (coeffdict, list of orphaned TimeSeries)
                                 # of those time series that are orphaned, i.e. no coefficient connects the ts to other ts
@@ -512,8 +658,7 @@ class TimeSeriesSet(object):
         res = [ ]
         for coeffid in cindex:
             ords = dict(my_ordinals)
-            db.cursor().execute("SELECT seriesid1,seriesid2,coeff FROM coeffvalue WHERE coeffid=?",[coeffid])
-            for (id1, id2, coeff) in self._db.cursor().fetchall():
+            for (id1, id2, coeff) in db.iterRows("SELECT seriesid1,seriesid2,coeff FROM coeffvalue WHERE coeffid=?",coeffid):
                 if id1 not in s2o: raise Exception, "seriesid1=%s not found for coeffid=%s" % (id1, coeffid)
                 if id2 not in s2o: raise Exception, "seriesid2=%s not found for coeffid=%s" % (id2, coeffid)
                 if coeff: ords[s2o[id1]] = ords[s2o[id2]] = True
@@ -534,25 +679,36 @@ class TimeSeriesSet(object):
         return ind
 
     @staticmethod
-    def slice_index(db):
+    def slice_index(db):                # { seriessetid => dict(label,starttime,endtime,interval,duration) }, computed once per connection; do not modify it
         assert db
+        return db.cached('slice_index',lambda: TimeSeriesSet._slice_index(db))
+
+    @staticmethod
+    def _slice_index(db):
         idx = TimeSeriesSet.index(db)
+        times = dict( (seriessetid, [ ]) for seriessetid in idx.keys() )
+        for seriessetid, time in db.iterRows("SELECT seriessetid,time FROM time ORDER BY seriessetid,timeid"):
+            if seriessetid in times:
+                times[seriessetid].append(time)
         res = dict()
         for seriessetid in idx.keys():
-            times = db.selectColumn("SELECT time FROM time WHERE seriessetid=? ORDER BY timeid",seriessetid)
-            interval = TimePoint.intervalOf(times)
+            interval = TimePoint.intervalOf(times[seriessetid])
             res[seriessetid] = dict(
                 label=idx[seriessetid],
-                starttime=times[0],
-                endtime=times[-1],
+                starttime=times[seriessetid][0],
+                endtime=times[seriessetid][-1],
                 interval=interval,
-                duration=TimePoint.fromString(interval,times[-1]) - TimePoint.fromString(interval,times[0]) + 1,
+                duration=TimePoint.fromString(interval,times[seriessetid][-1]) - TimePoint.fromString(interval,times[seriessetid][0]) + 1,
             )
         return res
 
     @staticmethod
-    def uniqueid(db):
+    def uniqueid(db):                   # identifies the database a configuration belongs to, computed once per connection
         assert db
+        return db.cached('uniqueid',lambda: TimeSeriesSet._uniqueid(db))
+
+    @staticmethod
+    def _uniqueid(db):
         try:
             u1 = ';'.join([ str(c) for c in db.selectRows("SELECT * FROM version ORDER BY number LIMIT 1")[0]])
         except:
@@ -576,6 +732,46 @@ class TimeSeriesSet(object):
         tss.lastreldelta_quintiles()
         evs = tss.events()
 
+        for ts in tss.series():
+            if ts.islumpy() and ts.max() >= ts.min():     # a lumpy series with at least one non-zero value holds its non-zero values through its zeros
+                assert not (ts._values == 0).any()
+            assert ((ts._intensities >= 1 - TimeSeriesSet.LUMPY_AMPLITUDE - 1e-12) & (ts._intensities <= 1)).all()
+
+        ts = tss.getseries(0)
+        ts.start().next()                                 # start() hands out copies, so the shared timepoints() are untouched
+        assert ts.start() == tss.timepoint(ts.startoff()) and tss.start() == tss.timepoints()[0] == TimePoint.timesStart(tss.times())
+
+        TimeSeriesSet.bulkload = False
+        pertss = TimeSeriesSet(db,tssids[0])
+        TimeSeriesSet.bulkload = True
+        assert len(pertss) == len(tss)
+        for ts, perts in zip(tss.series(),pertss.series()):
+            assert ts.seriesid() == perts.seriesid() and ts._dict == perts._dict
+            assert nullable(ts.getAllValues(),tss.ntimes()) == nullable(perts.getAllValues(),pertss.ntimes())
+            assert nullable(ts.getAllNormValues(),tss.ntimes()+1)[ts.startoff():ts.endoff()+2] == [ ts.getnormvalue(i) for i in range(ts.startoff(),ts.endoff()+2) ]
+
+        payloadtss = TimeSeriesSet(db,tssids[0],TimeSeriesSet.payload(db,tssids[0]))
+        assert len(payloadtss) == len(tss) and payloadtss.coeffids() == tss.coeffids()
+        assert numpy.array_equal(numpy.isnan(payloadtss.valuearray()),numpy.isnan(tss.valuearray()))
+        assert numpy.array_equal(numpy.nan_to_num(payloadtss.intensityarray()),numpy.nan_to_num(tss.intensityarray()))
+        for ts, payloadts in zip(tss.series(),payloadtss.series()):
+            assert ts.seriesid() == payloadts.seriesid() and ts._dict == payloadts._dict
+            assert nullable(ts.getAllValues(),tss.ntimes()) == nullable(payloadts.getAllValues(),payloadtss.ntimes())
+        for name in ('indptr','indices','data'):
+            assert numpy.array_equal(getattr(payloadtss.getcmat(),name),getattr(tss.getcmat(),name))
+
+        olddbfile = app.dbFilePath + ".v4000"             # a V4.000 database without the 'issymm' entries in its dict
+        shutil.copyfile(app.dbFilePath,olddbfile)
+        olddb = Database(olddbfile)
+        olddb.execute("DELETE FROM dict WHERE key='issymm'")
+        oldtss = TimeSeriesSet(olddb,tssids[0],TimeSeriesSet.payload(olddb,tssids[0]))
+        assert not oldtss.coefficients().values_issymmetrical() and not tss.coefficients().values_issymmetrical()
+        for name in ('indptr','indices','data'):
+            assert numpy.array_equal(getattr(oldtss.getcmat(),name),getattr(tss.getcmat(),name))
+        assert TimeSeriesSet(olddb,tssids[0]).coefficients().getmatrix('value').cardinality() == tss.getcmat().cardinality()
+        olddb.close()
+        os.remove(olddbfile)
+
         print "TimeSeries and TimeSeriesSet okay"
         print "EventSeries and EventSeriesSet okay"
 
@@ -620,15 +816,13 @@ class EventSeries(TimeSeries):
         if timelinestart.interval() != timelineend.interval():  
             raise Exception, "timeline start interval (%s) != the timeline end interval (%s)" % (timelinestart.interval(),timelineend.interval())
 
-        runner = timelinestart.clone()
         endoff = 0
-        while runner <= timelineend:
+        for runner in ess.timepoints():
             value = 0
             # Java suckage is reads much better in Python. Compare: if runner.compareTo(event.startdate) >= 0 && runner.compareTo(event.enddate) <= 0
             if runner >= startdate and runner <= enddate: value = displaytype
             self._values.append(value)
             endoff += 1
-            runner.next()
 
         self._dict["startoff"] = "0"
         self._dict["endoff"] = str(endoff)
@@ -604,8 +604,10 @@ class TimesliceFrequencySelector (QtGui.QComboBox):
         _frequency = self.root.timesliceFrequencySelector.currentText ()
         _choices = list ()
 
+        _sliceIndex = self.root.tss.slice_index (self.root.db)
+
         for i in self.root.tssids [1:]:
-            if self.root.tss.slice_index (self.root.db) [i] ['interval'] == _frequency:
+            if _sliceIndex [i] ['interval'] == _frequency:
                 _choices.append (i)
 
         if len (_choices) == 0:
@@ -640,8 +642,10 @@ class TimesliceSelector (QtGui.QComboBox):
         self.acceptChanges = False
         self.root.timesliceChoices = list ()
 
+        _sliceIndex = self.root.tss.slice_index (self.root.db)
+
         for _item in choices:
-            _itemLabel = self.root.tss.slice_index (self.root.db) [_item] ['starttime'] + '...' + self.root.tss.slice_index (self.root.db) [_item] ['endtime']
+            _itemLabel = _sliceIndex [_item] ['starttime'] + '...' + _sliceIndex [_item] ['endtime']
             self.root.timesliceChoices.append (_item)
             self.addItem (_itemLabel)
 
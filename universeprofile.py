@@ -86,7 +86,7 @@ class ProfileModel (QAbstractTableModel):
 
         for i in range (len (thisNode.root.nodes)):
             if normalised:
-                self.series.append (self.tss.series () [i].getAllNormValues ())
+                self.series.append (nullable (self.tss.series () [i].getAllNormValues (), self.tss.ntimes ())) # None, i.e. a blank cell, for a missing datapoint
             else:
                 self.series.append (self.tss.series () [i])
 
@@ -88,6 +88,7 @@ import sys
 #    4.040     Modified Message                 2013-05-27 AD Updated message for Domino and Communities
 #    4.041     Debugged multiple db issue       2013-05-29 AD Debugged issue related to loading multiple dbs
 #    4.042     Add from Centrifuge for XY       2013-06-23 AD Add from Centrifuge for XY
+#    4.043     Lookup indexes                   2026-10-18    Database schema v4.043: indexes for the loaders' lookups, created by coefficient.py --index
 
 
 class Version:
@@ -96,9 +97,9 @@ class Version:
     def tunit(verbose):
         print "Version %s/%s (%s) okay" % (Version.applicationVersion,Version.applicationDescription,Version.applicationDate)
 
-    applicationVersion = 4.042
+    applicationVersion = 4.043
     applicationDescription = "Brand Communities"
-    applicationDate = "2013-06-23"
+    applicationDate = "2026-10-18"
 
 
 if __name__ == '__main__': Version.tunit(len(sys.argv) > 1)
@@ -81,9 +81,10 @@ def axisLumpiness (root, association, axis, timeOffset, timeStep = None):
         _index = root.timeSlider.timeIndex () + timeOffset + _lag
 
     try:
-        _value = _ts.getAllIntensities () [_index]
+        _intensities = _ts.getAllIntensities ()
+        _value = _intensities [_index] if 0 <= _index < len (_intensities) else None
 
-        if _value == None:
+        if isnull (_value):
             _value = 0.0
     except:
         _value = 1.0
@@ -109,14 +110,15 @@ def transform (root, association, timesteps, axis, timeOffset, scaling, normalis
         _value = (_values [_index] - (float (root.timeSlider.startPosition) / (_fullRange))) * _m
     elif normalised:
         try:
-            _value = _ts.getAllNormValues () [_index]
+            _values = _ts.getAllNormValues ()
+            _value = _values [_index] if 0 <= _index < len (_values) else None
         except:
             try:
                 _value = _ts._normvalues [_index]
             except:
                 _value = None
 
-        if _value != None:
+        if not isnull (_value):
             if association [0].axis [axis].checkbox.checkState ():
                 _value = math.log10 ((_value + (1.0 / 9.0)) * 9.0)
             else:
@@ -125,15 +127,16 @@ def transform (root, association, timesteps, axis, timeOffset, scaling, normalis
             _value = _value * scaling
     else:
         try:
-            _value = _ts.getAllValues () [_index]
+            _values = _ts.getAllValues ()
+            _value = _values [_index] if 0 <= _index < len (_values) else None
         except:
             try:
                 _value = _ts._normvalues [_index]
             except:
                 _value = None
 
-    if _value == None:
-        return _value
+    if isnull (_value):
+        return None
     else:
         return _value * FACTOR
 
@@ -53,9 +53,9 @@ class ProfileModel (QAbstractTableModel):
         self.series = []
 
         if normalised:
-            self.series.append (tss.series () [association.axis [0].combo.selectionId].getAllNormValues ())
-            self.series.append (tss.series () [association.axis [1].combo.selectionId].getAllNormValues ())
-            self.series.append (tss.series () [association.axis [2].combo.selectionId].getAllNormValues ())
+            self.series.append (nullable (tss.series () [association.axis [0].combo.selectionId].getAllNormValues (), tss.ntimes ()))
+            self.series.append (nullable (tss.series () [association.axis [1].combo.selectionId].getAllNormValues (), tss.ntimes ()))
+            self.series.append (nullable (tss.series () [association.axis [2].combo.selectionId].getAllNormValues (), tss.ntimes ()))
         else:
             self.series.append (tss.series () [association.axis [0].combo.selectionId])
             self.series.append (tss.series () [association.axis [1].combo.selectionId])